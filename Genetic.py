@@ -1,11 +1,21 @@
 import pickle
 import re, os
-from random import triangular
+import gzip
+import mmap
+import struct
+import zlib
+import multiprocessing
+from random import triangular, random, sample
 from math import floor
 import sunfish
+import tools
+import book
 
 MAX_NUM_MOVES = 200
 SEARCH_TIME = 0.2
+# Transposition table size in MB. Searches of SEARCH_TIME don't fill more,
+# and a pool worker holds the searchers of all the engines it plays.
+TABLE_SIZE = 4
 
 class PST:
     def randomize_pst(pst, randomness):
@@ -30,8 +40,25 @@ class PST:
             new_pst[k] = sum((padrow(table[i*8:i*8+8]) for i in range(8)), ())
             new_pst[k] = (0,)*20 + new_pst[k] + (0,)*20
         return new_pst
+
+    # The endgame tables of the padded pst, with the engine's piece values
+    def generate_pst_taper(pst_padded, piece):
+        return sunfish.taper_tables(pst_padded, piece)
         
 
+    # Each square, and each piece value, comes from either parent
+    def crossover_pst(pst1, pst2):
+        new_pst = {}
+        for piece,table in pst1.items():
+            new_pst[piece] = tuple(a if random() < .5 else b for a,b in zip(table, pst2[piece]))
+        return new_pst
+
+    def crossover_piece(piece1, piece2):
+        new_piece = {}
+        for letter,value in piece1.items():
+            new_piece[letter] = value if random() < .5 else piece2[letter]
+        return new_piece
+
     def save_data(pst, piece, prefix):
         f = open('Store/' + prefix + '_pst.pckl', 'wb')
         pickle.dump(pst, f)
@@ -52,26 +79,44 @@ class PST:
 
 
 class Engine:
-    def __init__(self, prefix):
-        self.load_from_pckl(prefix)
-        self.pos = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0, self.pst_padded)
-        self.searcher = sunfish.Searcher()
+    # The engine is loaded from the pickles of prefix, or made from the
+    # (pst, piece) of params
+    def __init__(self, prefix=None, params=None):
+        if params is None:
+            self.load_from_pckl(prefix)
+        else:
+            self.pst, self.piece = params
+            self.pst_padded = PST.generate_pst_padded(self.pst, self.piece)
+            self.pst_taper = PST.generate_pst_taper(self.pst_padded, self.piece)
+        self.pos = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0, self.pst_padded,
+                                    pst_taper=self.pst_taper)
+        self.searcher = sunfish.Searcher(TABLE_SIZE)
     
     def reset_position(self):
-        self.pos = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0, self.pst_padded)
-        self.searcher = sunfish.Searcher()
+        self.pos = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0, self.pst_padded,
+                                    pst_taper=self.pst_taper)
+        self.searcher = sunfish.Searcher(TABLE_SIZE)
 
     def load_from_pckl(self, prefix):
         self.pst, self.piece = PST.load_data(prefix)
         self.pst_padded = PST.generate_pst_padded(self.pst, self.piece)
+        self.pst_taper = PST.generate_pst_taper(self.pst_padded, self.piece)
     
     def save_to_pckl(self, prefix):
         PST.save_data(self.pst, self.piece, prefix)
 
+    def params(self):
+        return self.pst, self.piece
+
+    # A 32 bit id of the parameters, to tell engines apart in the archive
+    def id(self):
+        return zlib.crc32(pickle.dumps(self.params()))
+
     def evolve(self, random_pst, random_piece):
         self.pst = PST.randomize_pst(self.pst, random_pst)
         self.piece = PST.randomize_piece(self.piece, random_piece)
         self.pst_padded = PST.generate_pst_padded(self.pst, self.piece)
+        self.pst_taper = PST.generate_pst_taper(self.pst_padded, self.piece)
 
     # Convert from 'd2d4' to '(84, 64)'
     def parse(self, c, black=False):
@@ -114,20 +159,101 @@ class Engine:
 
 
 
+class Archive:
+    # Games are appended to one binary file, path + '.bin'. A game is a
+    # header of the winner, the number of moves and the ids of the white and
+    # black engines, followed by the moves as 16 bits of from and to square.
+    # path + '.idx' has the offset of each game, so game n (counting from 1)
+    # is found without reading the games before it.
+    WINNERS = ["White", "Black", "Draw - Repetition", "Draw - Max Moves"]
+    HEADER = struct.Struct('<BHII')
+    OFFSET = struct.Struct('<Q')
+
+    def __init__(self, path='Games/games'):
+        self.path = path
+
+    def __len__(self):
+        if not os.path.isfile(self.path + '.idx'):
+            return 0
+        return os.path.getsize(self.path + '.idx') // self.OFFSET.size
+
+    # 'e2e4' is stored as 12 << 6 | 28
+    def encode_move(move):
+        square = lambda c: (ord(c[0]) - ord('a')) + 8*(int(c[1]) - 1)
+        return square(move[:2]) << 6 | square(move[2:])
+
+    def decode_move(code):
+        square = lambda k: chr(ord('a') + k%8) + str(k//8 + 1)
+        return square(code >> 6) + square(code & 63)
+
+    # Appends a game, and returns its number. The folder of the archive is
+    # made if need be.
+    def append(self, moves, winner, white_id=0, black_id=0):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        record = self.HEADER.pack(self.WINNERS.index(winner), len(moves), white_id, black_id)
+        record += struct.pack('<%dH' % len(moves), *map(Archive.encode_move, moves))
+        f = open(self.path + '.bin', 'ab')
+        offset = f.tell()
+        f.write(record)
+        f.close()
+        f = open(self.path + '.idx', 'ab')
+        f.write(self.OFFSET.pack(offset))
+        f.close()
+        return len(self)
+
+    def _read(self, data, offset):
+        winner, n, white_id, black_id = self.HEADER.unpack_from(data, offset)
+        codes = struct.unpack_from('<%dH' % n, data, offset + self.HEADER.size)
+        return [Archive.decode_move(c) for c in codes], self.WINNERS[winner], white_id, black_id
+
+    # The game numbered game_num, as (moves, winner, white id, black id)
+    def load(self, game_num):
+        f = open(self.path + '.idx', 'rb')
+        f.seek((game_num-1) * self.OFFSET.size)
+        offset, = self.OFFSET.unpack(f.read(self.OFFSET.size))
+        f.close()
+        f = open(self.path + '.bin', 'rb')
+        f.seek(offset)
+        header = f.read(self.HEADER.size)
+        data = header + f.read(2*self.HEADER.unpack(header)[1])
+        f.close()
+        return self._read(data, 0)
+
+    # All the games, read from a memory map of the archive
+    def games(self):
+        if len(self) == 0:
+            return
+        f = open(self.path + '.bin', 'rb')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.path + '.idx', 'rb') as idx:
+            index = idx.read()
+        for (offset,) in self.OFFSET.iter_unpack(index):
+            yield self._read(data, offset)
+        data.close()
+        f.close()
+
+
 class Game:
-    def __init__(self, white_engine, black_engine, print_pos):
+    # The opening moves come from opening_book, a book.Book, if given
+    def __init__(self, white_engine, black_engine, print_pos, opening_book=None):
         self.white = white_engine
         self.black = black_engine
         self.print = print_pos
         self.winner = ""
         self.moves = []
+        self.book = opening_book
 
-    def play(self):
+    # Plays the game, and appends it to the archive unless save is False
+    def play(self, save=True):
         self.white.reset_position()
         self.black.reset_position()
         while True:
             # White to move.
-            move, score = self.white.searcher.search(self.white.pos, secs=SEARCH_TIME)
+            move = self.book and self.book.choose(self.white.pos)
+            if not move:
+                move, score = self.white.searcher.search(self.white.pos, secs=SEARCH_TIME)
             self.white.pos = self.white.pos.move(move)
             self.black.pos = self.black.pos.move(move)
             self.moves.append(self.white.inv_parse(move, False))
@@ -141,7 +267,9 @@ class Game:
                 break
 
             # Black to move.
-            move, score = self.black.searcher.search(self.black.pos, secs=SEARCH_TIME)
+            move = self.book and self.book.choose(self.black.pos)
+            if not move:
+                move, score = self.black.searcher.search(self.black.pos, secs=SEARCH_TIME)
             self.white.pos = self.white.pos.move(move)
             self.black.pos = self.black.pos.move(move)
             self.moves.append(self.black.inv_parse(move, True))
@@ -164,22 +292,18 @@ class Game:
                     self.winner = "Draw - Max Moves"
                     break
         print(self.winner)
-        self.save_moves()
-
-    def save_moves(self):
-        game_num = 1
-        path = 'Games/' + str(game_num) + '.pckl'
-        while os.path.isfile(path):
-            game_num += 1
-            path = 'Games/' + str(game_num) + '.pckl'
-        f = open('Games/' + str(game_num) + '.pckl', 'wb')
-        pickle.dump(self.moves, f)
-        f.close()
-
-    def load_moves(self, game_num):
-        f = open('Games/' + str(game_num) + '.pckl', 'rb')
-        self.moves = pickle.load(f)
-        f.close()
+        if save:
+            self.save_moves()
+
+    def save_moves(self, archive=None):
+        if archive is None:
+            archive = Archive()
+        return archive.append(self.moves, self.winner, self.white.id(), self.black.id())
+
+    def load_moves(self, game_num, archive=None):
+        if archive is None:
+            archive = Archive()
+        self.moves, self.winner, _, _ = archive.load(game_num)
         self.white.reset_position()
         i = 0
         for move in self.moves:
@@ -195,69 +319,249 @@ class Game:
 
 
 class Match:
-    def __init__(self, engine1, engine2, num_games, print_pos=False):
+    # With a tools.SPRT as sprt, the match stops as soon as the test is
+    # decided, and num_games is the most games played with each colour
+    def __init__(self, engine1, engine2, num_games, print_pos=False, sprt=None):
         self.engine1 = engine1
         self.engine2 = engine2
         self.num_games = num_games
         self.print_pos = print_pos
+        self.sprt = sprt
         self.results = []
         self.score = 0
 
-    def play(self):
-        for i in range(self.num_games):
-            game = Game(self.engine1, self.engine2, self.print_pos)
-            game.play()
-            if game.winner == "White":
-                self.results.append(1)
-                self.score += 1
-            elif game.winner == "Black":
-                self.results.append(-1)
-                self.score -= 1
-            else:
-                self.results.append(0)
-        # Now switch sides
-        for i in range(self.num_games):
-            game = Game(self.engine2, self.engine1, self.print_pos)
-            game.play()
-            if game.winner == "Black":
-                self.results.append(1)
-                self.score += 1
-            elif game.winner == "White":
-                self.results.append(-1)
-                self.score -= 1
-            else:
-                self.results.append(0)
-        print("Results:", self.results)
-        print("Final score:", self.score)
-
-
-def train():
+    # The games, as (white, black, sign of the score if white wins). Each
+    # game is followed by its colour swapped, so a match stopped early has
+    # played both colours about as often.
+    def pairings(self):
+        return [(self.engine1, self.engine2, 1), (self.engine2, self.engine1, -1)]*self.num_games
+
+    def play(self, processes=None, archive=None):
+        play_matches([self], processes, archive)
+
+
+# The engines of the worker processes, by their index in play_matches, the
+# flags of the matches that were stopped and the opening book, loaded once
+_engines = []
+_stopped = None
+_book = None
+
+def _init_worker(params, stopped):
+    global _engines, _stopped, _book
+    _engines = [Engine(params=p) for p in params]
+    _stopped = stopped
+    _book = book.load()
+
+def _play_game(task):
+    m, g, white, black, print_pos = task
+    if _stopped[m]:
+        return m, g, None, None
+    game = Game(_engines[white], _engines[black], print_pos, _book)
+    game.play(save=False)
+    return m, g, game.winner, game.moves
+
+# Plays all the games of the matches on a pool of processes, by default one
+# per core, or in this process if processes is 1. The engine parameters are
+# sent once to each process, and the results come back as the games finish,
+# to be appended to the archive by this process only. archive is an Archive or
+# its path, by default Games/games. The games of the matches are interleaved,
+# so they progress together.
+def play_matches(matches, processes=None, archive=None):
+    if archive is None:
+        archive = Archive()
+    elif not isinstance(archive, Archive):
+        archive = Archive(archive)
+    engines, tasks = [], []
+    def index(engine):
+        for k, e in enumerate(engines):
+            if e is engine:
+                return k
+        engines.append(engine)
+        return len(engines) - 1
+    for m, match in enumerate(matches):
+        for g, (white, black, sign) in enumerate(match.pairings()):
+            tasks.append((g, m, index(white), index(black), match.print_pos))
+    tasks = [(m, g, white, black, print_pos) for g, m, white, black, print_pos in sorted(tasks)]
+    results = [[None]*len(match.pairings()) for match in matches]
+    stopped = multiprocessing.Array('b', len(matches), lock=False)
+    init = ([e.params() for e in engines], stopped)
+    if processes == 1:
+        _init_worker(*init)
+        pool = None
+        games = map(_play_game, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, init)
+        games = pool.imap_unordered(_play_game, tasks)
+    try:
+        for m, g, winner, moves in games:
+            match = matches[m]
+            if stopped[m]:
+                continue
+            white, black, sign = match.pairings()[g]
+            archive.append(moves, winner, white.id(), black.id())
+            results[m][g] = sign if winner == "White" else -sign if winner == "Black" else 0
+            if match.sprt is not None:
+                match.sprt.add(results[m][g])
+                print("Match", m+1, match.sprt)
+                stopped[m] = match.sprt.status() != 0
+            if all(stopped):
+                if pool is not None:
+                    pool.terminate()
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for match, result in zip(matches, results):
+        match.results = [r for r in result if r is not None]
+        match.score = sum(match.results)
+        print("Results:", match.results)
+        print("Final score:", match.score)
+
+
+def train(processes=None):
     #Configurations
     piece_randomness = 3
     pst_randomness = 4
     games_per_match = 2
+    challengers = 4
     generations = 100
     # Load current best engine
     engine1 = Engine("Init")
-    engine2 = Engine("Best")
-    engine2.evolve(pst_randomness, piece_randomness)
+    engines = [Engine("Best") for _ in range(challengers)]
+    for engine in engines:
+        engine.evolve(pst_randomness, piece_randomness)
     for gen in range(generations):
         print("\nGeneration", gen+1)
-        engine2.save_to_pckl("GEN"+str(gen+1))
-        match = Match(engine1, engine2, games_per_match, False)
-        match.play()
-        if match.score > 0:
-            print("Winner is Engine1!")
-            engine2.load_from_pckl("Best") # Copy engine 1
-            engine2.evolve(pst_randomness, piece_randomness)
-        elif match.score < 0:
-            print("Winner is Engine2!")
-            engine2.save_to_pckl("Best")
+        for k, engine in enumerate(engines):
+            engine.save_to_pckl("GEN"+str(gen+1)+"_"+str(k+1))
+        matches = [Match(engine1, engine, games_per_match, False) for engine in engines]
+        play_matches(matches, processes)
+        best = min(matches, key=lambda match: match.score)
+        if best.score < 0:
+            print("Winner is Engine2 of match", matches.index(best)+1)
+            best.engine2.save_to_pckl("Best")
             engine1.load_from_pckl("Best")
-            engine2.evolve(pst_randomness, piece_randomness)
         else:
-            print("Match ends in a draw")
-            engine2.evolve(pst_randomness, piece_randomness)
+            print("Winner is Engine1")
+        for engine, match in zip(engines, matches):
+            if match.score > 0 or best.score < 0:
+                engine.load_from_pckl("Best") # Copy engine 1
+            engine.evolve(pst_randomness, piece_randomness)
+
+class Population:
+    # K candidate engines, as (pst, piece) params. They play a tournament
+    # each generation, the better half survives, and the other half is
+    # replaced by mutated crossovers of the survivors.
+    def __init__(self, candidates, generation=0):
+        self.candidates = candidates
+        self.generation = generation
+        self.scores = [0]*len(candidates)
+
+    # A population of size mutations of the engine of prefix, and the engine
+    # itself
+    def seed(prefix, size, pst_randomness, piece_randomness):
+        pst, piece = PST.load_data(prefix)
+        candidates = [(pst, piece)]
+        for _ in range(size-1):
+            candidates.append((PST.randomize_pst(pst, pst_randomness),
+                               PST.randomize_piece(piece, piece_randomness)))
+        return Population(candidates)
+
+    # Every candidate plays every other, both colours games_per_pair times
+    def round_robin(self, games_per_pair=1, processes=None):
+        engines = [Engine(params=c) for c in self.candidates]
+        pairs = [(i, j) for i in range(len(engines)) for j in range(i+1, len(engines))]
+        matches = [Match(engines[i], engines[j], games_per_pair) for i, j in pairs]
+        play_matches(matches, processes)
+        self.scores = [0]*len(engines)
+        for (i, j), match in zip(pairs, matches):
+            self.scores[i] += match.score
+            self.scores[j] -= match.score
+
+    # Rounds of matches between candidates of about the same score so far,
+    # who haven't met yet if possible. With an odd number of candidates the
+    # last one sits the round out.
+    def swiss(self, rounds=3, games_per_pair=1, processes=None):
+        engines = [Engine(params=c) for c in self.candidates]
+        self.scores = [0]*len(engines)
+        played = set()
+        for r in range(rounds):
+            order = sample(range(len(engines)), len(engines))
+            order.sort(key=lambda i: -self.scores[i])
+            pairs = []
+            while len(order) > 1:
+                i = order.pop(0)
+                j = next((j for j in order if (i, j) not in played), order[0])
+                order.remove(j)
+                pairs.append((i, j))
+                played |= {(i, j), (j, i)}
+            matches = [Match(engines[i], engines[j], games_per_pair) for i, j in pairs]
+            play_matches(matches, processes)
+            for (i, j), match in zip(pairs, matches):
+                self.scores[i] += match.score
+                self.scores[j] -= match.score
+
+    # The params of the candidates by their scores, best first
+    def ranking(self):
+        order = sorted(range(len(self.candidates)), key=lambda i: -self.scores[i])
+        return [self.candidates[i] for i in order]
+
+    def next_generation(self, pst_randomness, piece_randomness):
+        survivors = self.ranking()[:(len(self.candidates)+1)//2]
+        children = []
+        while len(survivors) + len(children) < len(self.candidates):
+            (pst1, piece1), (pst2, piece2) = sample(survivors, 2) if len(survivors) > 1 \
+                else survivors*2
+            pst = PST.randomize_pst(PST.crossover_pst(pst1, pst2), pst_randomness)
+            piece = PST.randomize_piece(PST.crossover_piece(piece1, piece2), piece_randomness)
+            children.append((pst, piece))
+        self.candidates = survivors + children
+        self.scores = [0]*len(self.candidates)
+        self.generation += 1
+
+    # The whole population is kept in one compressed file, replaced
+    # atomically so a crash never leaves half a checkpoint
+    def save(self, path):
+        f = gzip.open(path + '.tmp', 'wb')
+        pickle.dump((self.generation, self.candidates, self.scores), f)
+        f.close()
+        os.replace(path + '.tmp', path)
+
+    def load(path):
+        f = gzip.open(path, 'rb')
+        generation, candidates, scores = pickle.load(f)
+        f.close()
+        population = Population(candidates, generation)
+        population.scores = scores
+        return population
+
+
+def train_population(processes=None):
+    #Configurations
+    piece_randomness = 3
+    pst_randomness = 4
+    size = 8
+    games_per_pair = 1
+    swiss_rounds = 0 # 0 for a round robin
+    generations = 100
+    checkpoint = 'Store/population.pckl.gz'
+    # Resume from the checkpoint, if there is one
+    if os.path.isfile(checkpoint):
+        population = Population.load(checkpoint)
+    else:
+        population = Population.seed("Best", size, pst_randomness, piece_randomness)
+    while population.generation < generations:
+        print("\nGeneration", population.generation+1)
+        if swiss_rounds:
+            population.swiss(swiss_rounds, games_per_pair, processes)
+        else:
+            population.round_robin(games_per_pair, processes)
+        print("Scores:", sorted(population.scores, reverse=True))
+        pst, piece = population.ranking()[0]
+        PST.save_data(pst, piece, "Best")
+        population.next_generation(pst_randomness, piece_randomness)
+        population.save(checkpoint)
 
 def playback(game_num):
     engine = Engine("Best")
@@ -272,7 +576,9 @@ def show_params(prefix):
 def play_stock():
     engine_trained = Engine("Best")
     engine_stock = Engine("Init")
-    match = Match(engine_trained, engine_stock,4)
+    # Up to 100 games with each colour, until it is clear whether the
+    # trained engine is at least 20 Elo stronger
+    match = Match(engine_trained, engine_stock, 100, sprt=tools.SPRT(0, 20))
     match.play()
     
 
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import numpy as np
+
+import sunfish
+
+###############################################################################
+# Batch evaluation with NumPy, for scoring many positions at once, e.g. the
+# training positions of a tuner. Boards are encoded as int8 arrays of shape
+# (N, 64), one code per square in the order of sunfish.sq120, and seen from
+# the side to move: 0 is empty, 1-6 are our PNBRQK and 7-12 the opponent's.
+# The score of a board is then a gather and sum over a (13, 64) table, and is
+# the same as Position.score.
+###############################################################################
+
+PIECES = 'PNBRQKpnbrqk'
+
+# The code of each character of a board
+_codes = np.zeros(256, dtype=np.int8)
+for _k, _p in enumerate(PIECES):
+    _codes[ord(_p)] = _k + 1
+# Our pieces become the opponent's, and the other way round
+_swap = np.array([0] + list(range(7, 13)) + list(range(1, 7)), dtype=np.int8)
+
+# Boards are scored this many at a time, to bound the memory of the gather
+CHUNK = 1 << 16
+
+
+def encode_boards(boards):
+    ''' Encodes 120 char boards, such as Position.board, seen from the side to
+    move. '''
+    boards = np.frombuffer(''.join(boards).encode(), dtype=np.uint8)
+    return _codes[boards.reshape(-1, 120)[:, sunfish.sq120]]
+
+
+def encode_fens(fens):
+    ''' Encodes the boards of FEN strings, seen from the side to move, just
+    like tools.parseFEN would. '''
+    fields = [fen.split(None, 2)[:2] for fen in fens]
+    # Expanding the empty squares of all the boards at once is much faster
+    # than one board at a time
+    boards = ''.join(board for board, _ in fields).replace('/', '')
+    for n in range(1, 9):
+        boards = boards.replace(str(n), '.'*n)
+    codes = _codes[np.frombuffer(boards.encode(), dtype=np.uint8)].reshape(-1, 64)
+    # Black sees the board rotated, so the squares are reversed
+    black = np.array([color == 'b' for _, color in fields], dtype=bool)
+    codes[black] = _swap[codes[black, ::-1]]
+    return codes
+
+
+def pst_table(pst=sunfish.pst):
+    ''' The (13, 64) table of the score of each code on each square, from
+    padded piece-square tables, like sunfish.pst or those of
+    Genetic.PST.generate_pst_padded. '''
+    table = np.zeros((13, 64), dtype=np.int64)
+    for k, p in enumerate('PNBRQK'):
+        table[k+1] = [pst[p][i] for i in sunfish.sq120]
+        table[k+7] = [-pst[p][119-i] for i in sunfish.sq120]
+    return table
+
+
+def pst_scores(codes, pst=sunfish.pst):
+    ''' The scores of the encoded boards, as an array of N integers '''
+    table = pst_table(pst).ravel()
+    squares = np.arange(64)
+    scores = np.empty(len(codes), dtype=np.int64)
+    for a in range(0, len(codes), CHUNK):
+        chunk = codes[a:a+CHUNK].astype(np.intp)
+        scores[a:a+CHUNK] = table[chunk*64 + squares].sum(axis=1)
+    return scores
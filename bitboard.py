@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import sunfish
+# Everything but the Position is shared with sunfish, and exported from here
+# as well, so this module can stand in for sunfish.
+from sunfish import *
+
+###############################################################################
+# A bitboard implementation of sunfish.Position. It has the same constructor,
+# attributes and gen_moves/move/value/rotate contract, with moves and the ep
+# and kp squares in the usual 120 char board coordinates, so it can stand in
+# for sunfish, e.g. `pypy -u xboard.py bitboard`.
+#
+# Internally the board is stored in absolute orientation, bit 0 is a1 and
+# bit 63 is h8, so rotating a position doesn't touch the bitboards.
+###############################################################################
+
+WHITE, BLACK = 0, 1
+PIECES = 'PNBRQK'
+M64 = (1 << 64) - 1
+
+# Translation between board indices, as seen by the side to move, and the
+# absolute squares of the bitboards.
+to_sq = ([-1]*120, [-1]*120)
+from_sq = ([0]*64, [0]*64)
+for _i in range(120):
+    _rank, _fil = divmod(_i, 10)
+    if 2 <= _rank <= 9 and 1 <= _fil <= 8:
+        _sq = (9-_rank)*8 + _fil-1
+        to_sq[WHITE][_i], to_sq[BLACK][_i] = _sq, 63-_sq
+        from_sq[WHITE][_sq], from_sq[BLACK][63-_sq] = _i, _i
+
+###############################################################################
+# Attack tables
+###############################################################################
+
+def _steps(sq, deltas, slide):
+    ''' Yields the squares reached from sq, stepping (file, rank) deltas '''
+    for df, dr in deltas:
+        f, r = sq % 8 + df, sq // 8 + dr
+        while 0 <= f < 8 and 0 <= r < 8:
+            yield r*8 + f
+            if not slide: break
+            f, r = f + df, r + dr
+
+def _bits(squares):
+    return sum(1 << s for s in set(squares))
+
+knight_attacks = [_bits(_steps(sq, ((1,2),(2,1),(2,-1),(1,-2),(-1,-2),(-2,-1),(-2,1),(-1,2)), False))
+                  for sq in range(64)]
+king_attacks = [_bits(_steps(sq, ((1,0),(1,1),(0,1),(-1,1),(-1,0),(-1,-1),(0,-1),(1,-1)), False))
+                for sq in range(64)]
+# Squares attacked by a pawn of the given colour
+pawn_attacks = ([_bits(_steps(sq, ((-1,1),(1,1)), False)) for sq in range(64)],
+                [_bits(_steps(sq, ((-1,-1),(1,-1)), False)) for sq in range(64)])
+
+# Sliding attacks, kindergarten style: for each square and each of its lines
+# (rank, file, diagonal, anti-diagonal) we store the mask of squares whose
+# occupancy matters, and a table from the masked occupancy to the attacked
+# squares. A dict takes the place of the usual magic multiplication, since it
+# is a perfect hash on the occupancy that runs at C speed.
+def _line_table(sq, deltas):
+    rays = [list(_steps(sq, (d,), True)) for d in deltas]
+    # The last square of a ray is attacked whether or not it is occupied
+    mask = _bits(s for ray in rays for s in ray[:-1])
+    table = {}
+    sub = 0
+    while True:
+        att = 0
+        for ray in rays:
+            for s in ray:
+                att |= 1 << s
+                if sub >> s & 1: break
+        table[sub] = att
+        # Carry-Rippler enumeration of all subsets of the mask
+        sub = (sub - mask) & mask
+        if sub == 0: break
+    return mask, table
+
+_rook_lines = (((1,0),(-1,0)), ((0,1),(0,-1)))
+_bishop_lines = (((1,1),(-1,-1)), ((1,-1),(-1,1)))
+rook_lines = [[_line_table(sq, ds) for ds in _rook_lines] for sq in range(64)]
+bishop_lines = [[_line_table(sq, ds) for ds in _bishop_lines] for sq in range(64)]
+
+def rook_attacks(sq, occ):
+    (m1, t1), (m2, t2) = rook_lines[sq]
+    return t1[occ & m1] | t2[occ & m2]
+
+def bishop_attacks(sq, occ):
+    (m1, t1), (m2, t2) = bishop_lines[sq]
+    return t1[occ & m1] | t2[occ & m2]
+
+def queen_attacks(sq, occ):
+    return rook_attacks(sq, occ) | bishop_attacks(sq, occ)
+
+def knight_attacks_(sq, occ):
+    return knight_attacks[sq]
+
+def king_attacks_(sq, occ):
+    return king_attacks[sq]
+
+# Castling as seen by each colour: for the west and east rights, the king's
+# and the rook's squares, the squares that must be empty and the king's
+# destination.
+castling = (
+    ((4, 0, 0b1110, 2), (4, 7, 0b1100000, 6)),
+    ((60, 63, 0b11 << 61, 62), (60, 56, 0b111 << 57, 58)),
+)
+
+###############################################################################
+# Chess logic
+###############################################################################
+
+class Position(sunfish.Position):
+    """ A state of a chess game, see sunfish.Position. Besides its attributes
+    color -- the side to move, BLACK if the board is rotated
+    pieces -- a bitboard for each of PNBRQK, both colours
+    occ -- a bitboard for each colour
+    squares -- a 64 char string of the pieces, in absolute orientation and
+               upper case for the side to move
+    """
+
+    def __init__(self, board, score, wc, bc, ep, kp, pst=pst, hash=None,
+                 taper=None, phase=None, material=None, pawn_hash=None,
+                 pst_taper=pst_taper):
+        color = BLACK if board.startswith('\n') else WHITE
+        pieces, occ, squares = [0]*6, [0, 0], ['.']*64
+        for i, p in enumerate(board):
+            if not p.isalpha(): continue
+            sq = to_sq[color][i]
+            owner = color if p.isupper() else 1-color
+            pieces[PIECES.index(p.upper())] |= 1 << sq
+            occ[owner] |= 1 << sq
+            squares[sq] = p
+        if hash is None or taper is None or pawn_hash is None:
+            ref = sunfish.Position(board, score, wc, bc, ep, kp, pst, hash, taper, phase,
+                                   material, pawn_hash, pst_taper)
+            hash, taper, phase, material = ref.hash, ref.taper, ref.phase, ref.material
+            pawn_hash = ref.pawn_hash
+        self._set(color, pieces, occ, ''.join(squares), score, wc, bc, ep, kp, pst, hash,
+                  taper, phase, material, pawn_hash, pst_taper)
+
+    def _set(self, color, pieces, occ, squares, score, wc, bc, ep, kp, pst, hash,
+             taper, phase, material, pawn_hash, pst_taper):
+        self.color = color
+        self.pieces = pieces
+        self.occ = occ
+        self.squares = squares
+        self._board = None
+        self.score = score
+        self.wc = wc
+        self.bc = bc
+        self.ep = ep
+        self.kp = kp
+        self.pst = pst
+        self.pst_taper = pst_taper
+        self.hash = hash
+        self.taper = taper
+        self.phase = phase
+        self.material = material
+        self.pawn_hash = pawn_hash
+
+    def _new(self, color, pieces, occ, squares, score, wc, bc, ep, kp, hash,
+             taper, phase, material, pawn_hash):
+        pos = Position.__new__(Position)
+        pos._set(color, pieces, occ, squares, score, wc, bc, ep, kp, self.pst, hash,
+                 taper, phase, material, pawn_hash, self.pst_taper)
+        return pos
+
+    @property
+    def board(self):
+        ''' The 120 char board, only built when asked for '''
+        if self._board is None:
+            rows = ''.join(' ' + self.squares[r*8:r*8+8] + '\n' for r in range(7, -1, -1))
+            board = '         \n'*2 + rows + '         \n'*2
+            self._board = board if self.color == WHITE else board[::-1]
+        return self._board
+
+    def piece(self, i):
+        ''' The piece on board index i, upper case if it belongs to us '''
+        return self.squares[to_sq[self.color][i]]
+
+    def gen_moves(self):
+        c = self.color
+        fr = from_sq[c]
+        us, them = self.occ[c], self.occ[1-c]
+        occ = us | them
+        P, Nb, B, R, Q, K = self.pieces
+        # Pawns. Captures are also allowed onto the ep and kp squares.
+        targets = them
+        if self.ep: targets |= 1 << to_sq[c][self.ep]
+        if self.kp: targets |= 1 << to_sq[c][self.kp]
+        targets &= ~us
+        pushes = ~occ & M64
+        doubles, up = (0xff00, 8) if c == WHITE else (0xff << 48, -8)
+        patt = pawn_attacks[c]
+        bb = P & us
+        while bb:
+            b = bb & -bb
+            bb ^= b
+            sq = b.bit_length() - 1
+            i = fr[sq]
+            to = sq + up
+            if pushes >> to & 1:
+                yield (i, fr[to])
+                if b & doubles and pushes >> (to+up) & 1:
+                    yield (i, fr[to+up])
+            att = patt[sq] & targets
+            while att:
+                t = att & -att
+                att ^= t
+                yield (i, fr[t.bit_length()-1])
+        # Pieces
+        free = ~us & M64
+        for bb, attacks in ((Nb & us, knight_attacks_), (B & us, bishop_attacks),
+                            (R & us, rook_attacks), (Q & us, queen_attacks),
+                            (K & us, king_attacks_)):
+            while bb:
+                b = bb & -bb
+                bb ^= b
+                sq = b.bit_length() - 1
+                att = attacks(sq, occ) & free
+                i = fr[sq]
+                while att:
+                    t = att & -att
+                    att ^= t
+                    yield (i, fr[t.bit_length()-1])
+        # Castling, by sliding the rook next to the king
+        for right, (ksq, rsq, between, to) in zip(self.wc, castling[c]):
+            if right and (K & us) >> ksq & 1 and ((R | Q) & us) >> rsq & 1 \
+                    and not occ & between:
+                yield (fr[ksq], fr[to])
+
+    def gen_captures(self):
+        c = self.color
+        fr, tsq = from_sq[c], to_sq[c]
+        us, them = self.occ[c], self.occ[1-c]
+        occ = us | them
+        P, Nb, B, R, Q, K = self.pieces
+        # Squares the king castled over count as captures, see value
+        targets = ptargets = them
+        if self.ep: ptargets |= 1 << tsq[self.ep]
+        if self.kp:
+            ptargets |= 1 << tsq[self.kp]
+            for k in (self.kp-1, self.kp, self.kp+1):
+                targets |= 1 << tsq[k]
+        targets &= ~us
+        ptargets &= ~us
+        # Pawn captures and promotions
+        last, up = (0xff << 56, 8) if c == WHITE else (0xff, -8)
+        patt = pawn_attacks[c]
+        bb = P & us
+        while bb:
+            b = bb & -bb
+            bb ^= b
+            sq = b.bit_length() - 1
+            i = fr[sq]
+            to = sq + up
+            if last >> to & 1 and not occ >> to & 1:
+                yield (i, fr[to])
+            att = patt[sq] & ptargets
+            while att:
+                t = att & -att
+                att ^= t
+                yield (i, fr[t.bit_length()-1])
+        for bb, attacks in ((Nb & us, knight_attacks_), (B & us, bishop_attacks),
+                            (R & us, rook_attacks), (Q & us, queen_attacks),
+                            (K & us, king_attacks_)):
+            while bb:
+                b = bb & -bb
+                bb ^= b
+                sq = b.bit_length() - 1
+                att = attacks(sq, occ) & targets
+                i = fr[sq]
+                while att:
+                    t = att & -att
+                    att ^= t
+                    yield (i, fr[t.bit_length()-1])
+
+    def rotate(self):
+        ''' Rotates the board, preserving enpassant '''
+        return self._new(
+            1-self.color, self.pieces, self.occ, self.squares.swapcase(),
+            -self.score, self.bc, self.wc,
+            119-self.ep if self.ep else 0,
+            119-self.kp if self.kp else 0,
+            zrotate(self.hash) ^ zobrist_side,
+            -self.taper, self.phase, zrotate(self.material),
+            zrotate(self.pawn_hash))
+
+    def nullmove(self):
+        ''' Like rotate, but clears ep and kp '''
+        hash = self.hash ^ zobrist_ep[self.ep] ^ zobrist_kp[self.kp]
+        return self._new(
+            1-self.color, self.pieces, self.occ, self.squares.swapcase(),
+            -self.score, self.bc, self.wc, 0, 0,
+            zrotate(hash) ^ zobrist_side,
+            -self.taper, self.phase, zrotate(self.material),
+            zrotate(self.pawn_hash))
+
+    def move(self, move):
+        i, j = move
+        c = self.color
+        tsq = to_sq[c]
+        a, b = tsq[i], tsq[j]
+        p, q = self.squares[a], self.squares[b]
+        pieces, occ, squares = list(self.pieces), list(self.occ), self.squares
+        # Copy variables and reset ep and kp
+        wc, bc, ep, kp = self.wc, self.bc, 0, 0
+        score = self.score + self.value(move)
+        taper = self.taper
+        if p in 'PK' or q in 'pk' or abs(j-self.kp) < 2:
+            taper += self.value(move, self.pst_taper)
+        phase = self.phase - phase_weight[q]
+        material = self.material - material_unit[q]
+        hash = self.hash ^ zobrist_ep[self.ep] ^ zobrist_kp[self.kp]
+        hash ^= zobrist_castle[wc, bc]
+        # Actual move
+        frto = 1 << a | 1 << b
+        pieces[PIECES.index(p)] ^= frto
+        occ[c] ^= frto
+        if q != '.':
+            pieces[PIECES.index(q.upper())] ^= 1 << b
+            occ[1-c] ^= 1 << b
+        if a < b:
+            squares = squares[:a] + '.' + squares[a+1:b] + squares[a] + squares[b+1:]
+        else:
+            squares = squares[:b] + squares[a] + squares[b+1:a] + '.' + squares[a+1:]
+        hash ^= zobrist[p][i] ^ zobrist[p][j] ^ zobrist[q][j]
+        pawn_hash = self.pawn_hash ^ zobrist_pawn[p][i] ^ zobrist_pawn[p][j] ^ zobrist_pawn[q][j]
+        # Castling rights, we move the rook or capture the opponent's
+        if i == A1: wc = (False, wc[1])
+        if i == H1: wc = (wc[0], False)
+        if j == A8: bc = (bc[0], False)
+        if j == H8: bc = (False, bc[1])
+        # Castling
+        if p == 'K':
+            wc = (False, False)
+            if abs(j-i) == 2:
+                kp = (i+j)//2
+                r0, r1 = tsq[A1 if j < i else H1], tsq[kp]
+                frto = 1 << r0 | 1 << r1
+                pieces[3] ^= frto
+                occ[c] ^= frto
+                squares = _put(_put(squares, r0, '.'), r1, squares[r0])
+                hash ^= zobrist['R'][A1 if j < i else H1] ^ zobrist['R'][kp]
+        # Pawn promotion, double move and en passant capture
+        if p == 'P':
+            if A8 <= j <= H8:
+                pieces[0] ^= 1 << b
+                pieces[4] ^= 1 << b
+                squares = _put(squares, b, 'Q')
+                hash ^= zobrist['P'][j] ^ zobrist['Q'][j]
+                pawn_hash ^= zobrist['P'][j]
+                phase += phase_weight['Q']
+                material += material_unit['Q'] - material_unit['P']
+            if j - i == 2*N:
+                ep = i + N
+            if j - i in (N+W, N+E) and q == '.':
+                s = tsq[j+S]
+                r = squares[s]
+                if r != '.':
+                    pieces[PIECES.index(r.upper())] ^= 1 << s
+                    occ[c if r.isupper() else 1-c] ^= 1 << s
+                    squares = _put(squares, s, '.')
+                    hash ^= zobrist[r][j+S]
+                    pawn_hash ^= zobrist_pawn[r][j+S]
+                    material -= material_unit[r]
+        hash ^= zobrist_castle[wc, bc] ^ zobrist_ep[ep] ^ zobrist_kp[kp]
+        # We return the position rotated, so it's ready for the next player
+        return self._new(
+            1-c, pieces, occ, squares.swapcase(), -score, bc, wc,
+            119-ep if ep else 0, 119-kp if kp else 0,
+            zrotate(hash) ^ zobrist_side, -taper, phase, zrotate(material),
+            zrotate(pawn_hash))
+
+    def value(self, move, pst=None):
+        i, j = move
+        tsq = to_sq[self.color]
+        p, q = self.squares[tsq[i]], self.squares[tsq[j]]
+        pst = self.pst if pst is None else pst
+        # Actual move
+        score = pst[p][j] - pst[p][i]
+        # Capture
+        if q.islower():
+            score += pst[q.upper()][119-j]
+        # Castling check detection
+        if abs(j-self.kp) < 2:
+            score += pst['K'][119-j]
+        # Castling
+        if p == 'K' and abs(i-j) == 2:
+            score += pst['R'][(i+j)//2]
+            score -= pst['R'][A1 if j < i else H1]
+        # Special pawn stuff
+        if p == 'P':
+            if A8 <= j <= H8:
+                score += pst['Q'][j] - pst['P'][j]
+            if j == self.ep:
+                score += pst['P'][119-(j+S)]
+        return score
+
+    def mvv_lva(self, move):
+        i, j = move
+        tsq = to_sq[self.color]
+        p, q = self.squares[tsq[i]], self.squares[tsq[j]]
+        if q.islower():
+            return mvv_lva[p, q.upper()]
+        if abs(j-self.kp) < 2:
+            return mvv_lva[p, 'K']
+        if p == 'P':
+            if A8 <= j <= H8:
+                return mvv_lva[p, 'Q']
+            if j == self.ep:
+                return mvv_lva[p, 'P']
+        return 0
+
+    def in_check(self):
+        c = self.color
+        P, Nb, B, R, Q, K = self.pieces
+        them = self.occ[1-c]
+        occ = self.occ[c] | them
+        sq = (K & self.occ[c]).bit_length() - 1
+        return bool(them & (pawn_attacks[c][sq] & P | knight_attacks[sq] & Nb
+                            | bishop_attacks(sq, occ) & (B | Q)
+                            | rook_attacks(sq, occ) & (R | Q) | king_attacks[sq] & K))
+
+    def see(self, move):
+        i, j = move
+        if abs(j-self.kp) < 2:
+            return init_piece['K']
+        c = self.color
+        tsq = to_sq[c]
+        a, b = tsq[i], tsq[j]
+        p, q = self.squares[a], self.squares[b]
+        occ = (self.occ[0] | self.occ[1]) ^ 1 << a
+        gain = [init_piece.get(q.upper(), 0)]
+        last = init_piece[p]
+        if p == 'P':
+            if j == self.ep:
+                gain[0] = init_piece['P']
+                occ ^= 1 << tsq[j+S]
+            if A8 <= j <= H8:
+                gain[0] += init_piece['Q'] - init_piece['P']
+                last = init_piece['Q']
+        P, Nb, B, R, Q, K = self.pieces
+        # Sliders are looked up with the current occupancy, so removing each
+        # capturer uncovers its x-rays
+        side = 1-c
+        while True:
+            mine = self.occ[side] & occ
+            diag, line = bishop_attacks(b, occ), rook_attacks(b, occ)
+            for k, att in enumerate((pawn_attacks[1-side][b] & P, knight_attacks[b] & Nb,
+                                     diag & B, line & R, (diag | line) & Q,
+                                     king_attacks[b] & K)):
+                att &= mine
+                if att: break
+            else:
+                break
+            gain.append(last - gain[-1])
+            occ ^= att & -att
+            last = init_piece[PIECES[k]]
+            side = 1-side
+        while len(gain) > 1:
+            score = gain.pop()
+            gain[-1] = min(gain[-1], -score)
+        return gain[0]
+
+def _put(squares, sq, p):
+    return squares[:sq] + p + squares[sq+1:]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import multiprocessing
+from multiprocessing import shared_memory
+
+import sunfish
+import tablebase
+
+###############################################################################
+# Lazy SMP. Under CPython threads can't search in parallel, so we use helper
+# processes instead. Each helper runs the normal iterative deepening search
+# from the root, and all of them share one transposition table in shared
+# memory. The helpers mostly fill the table with results that the main
+# search then finds, and the entries are verified by their xor'ed keys
+# rather than locked (see sunfish.TranspositionTable). Each job carries the
+# settings of the main search, so the helpers search the same way, with the
+# tablebases opened from the same folder.
+###############################################################################
+
+class ParallelSearcher(sunfish.Searcher):
+    """ A Searcher using `threads` processes in total, itself included.
+    nodes counts the nodes of this process only, helper_nodes those of each
+    helper in the current search. Call close() when done with it. """
+
+    def __init__(self, threads=2, table_size=sunfish.TABLE_SIZE, make_unmake=False):
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=sunfish.TranspositionTable.bytes(table_size))
+        table = sunfish.TranspositionTable(table_size, self.shm.buf)
+        sunfish.Searcher.__init__(self, table_size, make_unmake, table)
+        # Helpers stop searching once the generation moves on
+        self.generation = multiprocessing.Value('i', 0, lock=False)
+        self.helper_nodes = multiprocessing.Array('q', threads-1, lock=False)
+        self.jobs = [multiprocessing.Queue() for _ in range(threads-1)]
+        self.helpers = [multiprocessing.Process(
+            target=_helper, daemon=True,
+            args=(self.shm.name, table_size, make_unmake, k, self.jobs[k],
+                  self.generation, self.helper_nodes))
+            for k in range(threads-1)]
+        for helper in self.helpers:
+            helper.start()
+
+    def _search(self, pos, first_depth=1):
+        self.generation.value += 1
+        for k, jobs in enumerate(self.jobs):
+            self.helper_nodes[k] = 0
+            jobs.put((pos, self.tp.age, self.generation.value, self.pvs,
+                      getattr(self.tablebase, 'path', None)))
+        try:
+            for _ in sunfish.Searcher._search(self, pos, first_depth):
+                yield
+        finally:
+            self.generation.value += 1
+
+    def close(self):
+        for jobs in self.jobs:
+            jobs.put(None)
+        for helper in self.helpers:
+            helper.join(1)
+            if helper.is_alive():
+                helper.terminate()
+        # Release our views of the shared memory before closing it
+        del self.tp
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _helper(name, table_size, make_unmake, k, jobs, generation, nodes):
+    shm = shared_memory.SharedMemory(name=name)
+    table = sunfish.TranspositionTable(table_size, shm.buf)
+    searcher = sunfish.Searcher(table_size, make_unmake, table)
+    # Every other helper starts a depth ahead of the main search, so the
+    # processes are spread over two depths rather than all doing the same work
+    first_depth = 1 + k % 2
+    tablebases, tablebase_path = None, None
+    for pos, age, gen, pvs, path in iter(jobs.get, None):
+        # The age is bumped by _search, just like in the main process
+        table.age = age
+        searcher.pvs = pvs
+        if path != tablebase_path:
+            if tablebases is not None:
+                tablebases.close()
+            tablebases, tablebase_path = path and tablebase.load(path), path
+        searcher.tablebase = tablebases
+        # A helper stops as soon as the main search does, even in a depth
+        searcher.should_stop = lambda: generation.value != gen
+        for _ in searcher._search(pos, first_depth):
+            nodes[k] = searcher.nodes
+            if generation.value != gen:
+                break
+    if tablebases is not None:
+        tablebases.close()
+    del table, searcher
+    shm.close()
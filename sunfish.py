@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-import re, sys, time
-from itertools import count
-from collections import OrderedDict, namedtuple
+import re, sys, time, random
+from itertools import count, product
+from array import array
 
 ###############################################################################
 # Piece-Square tables. Tune these to change sunfish's behaviour
@@ -60,11 +60,47 @@ init_pst = {
             -4,   3, -14, -50, -57, -18,  13,   4,
             17,  30,  -3, -14,   6,  -1,  40,  18),
 }
-# Pad tables and join piece and pst dictionaries
-# for k, table in pst.items():
-#     padrow = lambda row: (0,) + tuple(x+piece[k] for x in row) + (0,)
-#     pst[k] = sum((padrow(table[i*8:i*8+8]) for i in range(8)), ())
-#     pst[k] = (0,)*20 + pst[k] + (0,)*20
+# Endgame tables, for the pieces whose best squares change as the board
+# empties. The other pieces keep their middle game tables in the endgame.
+init_pst_eg = {
+    'P': (   0,   0,   0,   0,   0,   0,   0,   0,
+           120, 120, 120, 120, 120, 120, 120, 120,
+            70,  70,  70,  70,  70,  70,  70,  70,
+            35,  35,  35,  35,  35,  35,  35,  35,
+            15,  15,  15,  15,  15,  15,  15,  15,
+             5,   5,   5,   5,   5,   5,   5,   5,
+             0,   0,   0,   0,   0,   0,   0,   0,
+             0,   0,   0,   0,   0,   0,   0,   0),
+    'K': ( -50, -30, -30, -30, -30, -30, -30, -50,
+           -30, -10,   0,   0,   0,   0, -10, -30,
+           -30,   0,  20,  30,  30,  20,   0, -30,
+           -30,   0,  30,  40,  40,  30,   0, -30,
+           -30,   0,  30,  40,  40,  30,   0, -30,
+           -30,   0,  20,  30,  30,  20,   0, -30,
+           -30, -10,   0,   0,   0,   0, -10, -30,
+           -50, -30, -30, -30, -30, -30, -30, -50),
+}
+def pad_tables(tables, piece):
+    ''' Pads the tables to the 120 squares of the board, and adds the piece
+    values '''
+    padded = {}
+    for k, table in tables.items():
+        padrow = lambda row: (0,) + tuple(x+piece[k] for x in row) + (0,)
+        padded[k] = sum((padrow(table[i*8:i*8+8]) for i in range(8)), ())
+        padded[k] = (0,)*20 + padded[k] + (0,)*20
+    return padded
+
+def taper_tables(pst, piece, tables_eg=init_pst_eg):
+    ''' The endgame tables, with the piece values, as their difference to the
+    padded middle game tables pst '''
+    eg = pad_tables(tables_eg, piece)
+    return {k: tuple(e-m for e, m in zip(eg.get(k, pst[k]), pst[k])) for k in pst}
+
+# Pad tables and join piece and pst dictionaries. This is the default table
+# used by Position, tuned tables can be passed in instead (see Genetic.py),
+# along with taper tables built from their piece values.
+pst = pad_tables(init_pst, init_piece)
+pst_taper = taper_tables(pst, init_piece)
 
 ###############################################################################
 # Global constants
@@ -107,12 +143,95 @@ directions = {
 MATE_LOWER = init_piece['K'] - 10*init_piece['Q']
 MATE_UPPER = init_piece['K'] + 10*init_piece['Q']
 
-# The table size is the maximum number of elements in the transposition table.
-TABLE_SIZE = 1e8
+# The phase is the sum of the weights of the pieces on the board. The score is
+# tapered from the middle game to the endgame tables as it goes from PHASE_MAX
+# to 0.
+PHASE_MAX = 24
+phase_weight = {'.': 0}
+# Material is counted in four bits per piece type, ours in the low 32 bits and
+# the opponent's in the high 32 bits, so rotating the board is zrotate.
+material_unit = {'.': 0}
+for k, p in enumerate('PNBRQK'):
+    phase_weight[p] = phase_weight[p.lower()] = (0, 1, 1, 2, 4, 0)[k]
+    material_unit[p], material_unit[p.lower()] = 1 << 4*k, 1 << 4*k+32
+
+# The table size is the size of the transposition table in megabytes.
+TABLE_SIZE = 64
+# The number of entries of the pawn structure table
+PAWN_TABLE_SIZE = 1 << 16
+
+# Pawn structure, see pawn_structure. Passed pawns get a bonus by the row of
+# the board they are on, the closer to promotion the larger.
+DOUBLED_PAWN = -10
+ISOLATED_PAWN = -15
+passed_pawn = (0, 0, 0, 60, 40, 25, 15, 10, 10, 0)
+
+# Capture ordering, most valuable victim first and then least valuable attacker
+mvv_lva = {(p, q): 8*'PNBRQK'.index(q) - 'PNBRQK'.index(p) + 8
+           for p in 'PNBRQK' for q in 'PNBRQK'}
+# The keys of captures of a piece worth at least the capturer. Those can't
+# lose material, so they need no static exchange evaluation.
+safe_captures = {mvv_lva[p, q] for p, q in mvv_lva if init_piece[p] <= init_piece[q]}
 
 # Constants for tuning search
 QS_LIMIT = 150
 EVAL_ROUGHNESS = 20
+# The PVS driver first searches within this distance of the last score
+ASPIRATION_WINDOW = 50
+# Quiet moves after the first LMR_MOVES are searched LMR_REDUCTION plies
+# shallower at depths from LMR_DEPTH, and again at full depth if they fail high
+LMR_DEPTH = 3
+LMR_MOVES = 4
+LMR_REDUCTION = 1
+# Up to FUTILITY_DEPTH, quiet moves are pruned when the score plus
+# FUTILITY_MARGIN per ply is below gamma, and the node fails high when the
+# score minus REVERSE_FUTILITY_MARGIN per ply is above it
+FUTILITY_DEPTH = 2
+FUTILITY_MARGIN = 200
+REVERSE_FUTILITY_MARGIN = 150
+# Iterative deepening stops before this depth, so it also bounds the ply of
+# any node with depth > 0, which is where killers are kept.
+MAX_DEPTH = 1000
+# The search asks Searcher.should_stop whether to stop every STOP_NODES nodes
+STOP_NODES = 256
+
+###############################################################################
+# Zobrist hashing
+###############################################################################
+
+# Random 64 bit keys for each piece on each square. The tables are chosen such
+# that rotating the board corresponds to swapping the two 32 bit halves of the
+# key, that is zobrist[p.swapcase()][119-i] == zrotate(zobrist[p][i]). Hence
+# rotate can update the hash without looking at the board.
+def zrotate(key):
+    return key >> 32 | (key & 0xffffffff) << 32
+
+_zrand = random.Random(0)
+def _zsquares(empty):
+    keys = [0 if i == empty else _zrand.getrandbits(64) for i in range(60)]
+    return tuple(keys + [zrotate(keys[119-i]) for i in range(60, 120)])
+def _zsymmetric():
+    half = _zrand.getrandbits(32)
+    return half | half << 32
+
+zobrist = {'.': (0,)*120}
+for k in 'PNBRQK':
+    zobrist[k] = tuple(_zrand.getrandbits(64) for _ in range(120))
+    zobrist[k.lower()] = tuple(zrotate(zobrist[k][119-i]) for i in range(120))
+# No en passant or king passant square is encoded as 0
+zobrist_ep = _zsquares(empty=0)
+zobrist_kp = _zsquares(empty=0)
+zobrist_castle = {}
+for wc in product((False, True), repeat=2):
+    for bc in product((False, True), repeat=2):
+        if (bc, wc) in zobrist_castle:
+            zobrist_castle[wc, bc] = zrotate(zobrist_castle[bc, wc])
+        else:
+            zobrist_castle[wc, bc] = _zsymmetric() if wc == bc else _zrand.getrandbits(64)
+zobrist_side = _zsymmetric()
+# The pawn key only hashes the pawns, so it changes just by pawn moves and
+# captures of pawns.
+zobrist_pawn = {k: zobrist[k] if k in 'Pp' else (0,)*120 for k in zobrist}
 
 
 ###############################################################################
@@ -127,9 +246,19 @@ class Position:
     bc -- the opponent castling rights, [west/king side, east/queen side]
     ep - the en passant square
     kp - the king passant square
+    pst - the padded piece-square tables used for the score
+    pst_taper - the endgame tables, as their difference to pst
+    hash - the zobrist key, computed from scratch if not given
+    pawn_hash - the zobrist key of the pawns, computed if not given
+    taper - how much better the endgame tables evaluate the board than score
+    phase - the game phase, see PHASE_MAX
+    material - the piece counts, see material_unit
+    The last three are computed from scratch if taper isn't given.
     """
 
-    def __init__(self, board, score, wc, bc, ep, kp, pst):
+    def __init__(self, board, score, wc, bc, ep, kp, pst=pst, hash=None,
+                 taper=None, phase=None, material=None, pawn_hash=None,
+                 pst_taper=pst_taper):
         self.board = board
         self.score = score
         self.wc = wc
@@ -137,6 +266,45 @@ class Position:
         self.ep = ep
         self.kp = kp
         self.pst = pst
+        self.pst_taper = pst_taper
+        if taper is None:
+            taper, phase, material = 0, 0, 0
+            for i, p in enumerate(board):
+                if p.isupper(): taper += pst_taper[p][i]
+                if p.islower(): taper -= pst_taper[p.upper()][119-i]
+                if p.isalpha():
+                    phase += phase_weight[p]
+                    material += material_unit[p]
+        self.taper = taper
+        self.phase = phase
+        self.material = material
+        if hash is None:
+            hash = zobrist_castle[wc, bc] ^ zobrist_ep[ep] ^ zobrist_kp[kp]
+            for i, p in enumerate(board):
+                if p in zobrist: hash ^= zobrist[p][i]
+            # The board is rotated when black is to move, see tools.get_color
+            if board.startswith('\n'): hash ^= zobrist_side
+        self.hash = hash
+        if pawn_hash is None:
+            pawn_hash = 0
+            for i, p in enumerate(board):
+                if p in zobrist_pawn: pawn_hash ^= zobrist_pawn[p][i]
+        self.pawn_hash = pawn_hash
+
+    # Positions are compared by their zobrist key, so transpositions reached
+    # by different move orders share entries in the transposition table.
+    def __eq__(self, other):
+        return self.hash == other.hash
+
+    def __ne__(self, other):
+        return self.hash != other.hash
+
+    def __hash__(self):
+        return self.hash
+
+    def piece(self, i):
+        ''' The piece on board index i, upper case if it belongs to us '''
+        return self.board[i]
 
     def gen_moves(self):
         # For each of our pieces, iterate through each possible 'ray' of moves,
@@ -161,18 +329,44 @@ class Position:
                     if i == A1 and self.board[j+E] == 'K' and self.wc[0]: yield (j+E, j+W)
                     if i == H1 and self.board[j+W] == 'K' and self.wc[1]: yield (j+W, j+E)
 
+    def gen_captures(self):
+        ''' The moves of gen_moves with a positive mvv_lva, that is captures
+        and promotions. Rays are only followed until they hit a piece. '''
+        board, kp = self.board, self.kp
+        for i, p in enumerate(board):
+            if not p.isupper(): continue
+            if p == 'P':
+                if A8 <= i+N <= H8 and board[i+N] == '.': yield (i, i+N)
+                for j in (i+N+W, i+N+E):
+                    if board[j].islower() or j in (self.ep, kp): yield (i, j)
+                continue
+            for d in directions[p]:
+                for j in count(i+d, d):
+                    q = board[j]
+                    if q.isspace() or q.isupper(): break
+                    # Empty squares count if the king just castled over them
+                    if q.islower() or abs(j-kp) < 2: yield (i, j)
+                    if p in 'NK' or q.islower(): break
+
     def rotate(self):
         ''' Rotates the board, preserving enpassant '''
+        hash = zrotate(self.hash) ^ zobrist_side
         return Position(
             self.board[::-1].swapcase(), -self.score, self.bc, self.wc,
             119-self.ep if self.ep else 0,
-            119-self.kp if self.kp else 0, self.pst)
+            119-self.kp if self.kp else 0, self.pst, hash,
+            -self.taper, self.phase, zrotate(self.material),
+            zrotate(self.pawn_hash), self.pst_taper)
 
     def nullmove(self):
         ''' Like rotate, but clears ep and kp '''
+        hash = self.hash ^ zobrist_ep[self.ep] ^ zobrist_kp[self.kp]
+        hash = zrotate(hash) ^ zobrist_side
         return Position(
             self.board[::-1].swapcase(), -self.score,
-            self.bc, self.wc, 0, 0, self.pst)
+            self.bc, self.wc, 0, 0, self.pst, hash,
+            -self.taper, self.phase, zrotate(self.material),
+            zrotate(self.pawn_hash), self.pst_taper)
 
     def move(self, move):
         i, j = move
@@ -182,9 +376,19 @@ class Position:
         board = self.board
         wc, bc, ep, kp = self.wc, self.bc, 0, 0
         score = self.score + self.value(move)
+        taper = self.taper
+        # The tables only differ for kings and pawns
+        if p in 'PK' or q in 'pk' or abs(j-self.kp) < 2:
+            taper += self.value(move, self.pst_taper)
+        phase = self.phase - phase_weight[q]
+        material = self.material - material_unit[q]
+        hash = self.hash ^ zobrist_ep[self.ep] ^ zobrist_kp[self.kp]
+        hash ^= zobrist_castle[wc, bc]
         # Actual move
         board = put(board, j, board[i])
         board = put(board, i, '.')
+        hash ^= zobrist[p][i] ^ zobrist[p][j] ^ zobrist[q][j]
+        pawn_hash = self.pawn_hash ^ zobrist_pawn[p][i] ^ zobrist_pawn[p][j] ^ zobrist_pawn[q][j]
         # Castling rights, we move the rook or capture the opponent's
         if i == A1: wc = (False, wc[1])
         if i == H1: wc = (wc[0], False)
@@ -197,78 +401,456 @@ class Position:
                 kp = (i+j)//2
                 board = put(board, A1 if j < i else H1, '.')
                 board = put(board, kp, 'R')
+                hash ^= zobrist['R'][A1 if j < i else H1] ^ zobrist['R'][kp]
         # Pawn promotion, double move and en passant capture
         if p == 'P':
             if A8 <= j <= H8:
                 board = put(board, j, 'Q')
+                hash ^= zobrist['P'][j] ^ zobrist['Q'][j]
+                pawn_hash ^= zobrist['P'][j]
+                phase += phase_weight['Q']
+                material += material_unit['Q'] - material_unit['P']
             if j - i == 2*N:
                 ep = i + N
             if j - i in (N+W, N+E) and q == '.':
                 board = put(board, j+S, '.')
+                hash ^= zobrist['p'][j+S]
+                pawn_hash ^= zobrist['p'][j+S]
+                material -= material_unit['p']
+        hash ^= zobrist_castle[wc, bc] ^ zobrist_ep[ep] ^ zobrist_kp[kp]
         # We rotate the returned position, so it's ready for the next player
-        return Position(board, score, wc, bc, ep, kp, self.pst).rotate()
+        return Position(board, score, wc, bc, ep, kp, self.pst, hash,
+                        taper, phase, material, pawn_hash, self.pst_taper).rotate()
 
-    def value(self, move):
+    def value(self, move, pst=None):
+        ''' The change in score by move, or by the given tables '''
         i, j = move
         p, q = self.board[i], self.board[j]
+        pst = self.pst if pst is None else pst
         # Actual move
-        score = self.pst[p][j] - self.pst[p][i]
+        score = pst[p][j] - pst[p][i]
         # Capture
         if q.islower():
-            score += self.pst[q.upper()][119-j]
+            score += pst[q.upper()][119-j]
         # Castling check detection
         if abs(j-self.kp) < 2:
-            score += self.pst['K'][119-j]
+            score += pst['K'][119-j]
         # Castling
         if p == 'K' and abs(i-j) == 2:
-            score += self.pst['R'][(i+j)//2]
-            score -= self.pst['R'][A1 if j < i else H1]
+            score += pst['R'][(i+j)//2]
+            score -= pst['R'][A1 if j < i else H1]
         # Special pawn stuff
         if p == 'P':
             if A8 <= j <= H8:
-                score += self.pst['Q'][j] - self.pst['P'][j]
+                score += pst['Q'][j] - pst['P'][j]
             if j == self.ep:
-                score += self.pst['P'][119-(j+S)]
+                score += pst['P'][119-(j+S)]
+        return score
+
+    def evaluate(self, pawns=None):
+        ''' The score, tapered from the middle game to the endgame tables by
+        the phase, plus the pawn structure, which is looked up in the
+        PawnTable pawns if given. A side without pawns, rooks or queens, and
+        with at most one minor piece, can't win. '''
+        if pawns is None:
+            score = self.score + pawn_structure(self.board)
+        else:
+            score = self.score + pawns.get(self)
+        if self.phase >= PHASE_MAX:
+            return score
+        score += self.taper * (PHASE_MAX-self.phase) // PHASE_MAX
+        ours, theirs = self.material & 0xffffffff, self.material >> 32
+        if score > 0 and not ours & 0xff00f and (ours >> 4 & 15) + (ours >> 8 & 15) <= 1:
+            return 0
+        if score < 0 and not theirs & 0xff00f and (theirs >> 4 & 15) + (theirs >> 8 & 15) <= 1:
+            return 0
         return score
 
+    def mvv_lva(self, move):
+        ''' The capture ordering key of move, 0 if it is a quiet move.
+        Promotions count as capturing a queen. '''
+        i, j = move
+        p, q = self.board[i], self.board[j]
+        if q.islower():
+            return mvv_lva[p, q.upper()]
+        # Castling check detection, see value
+        if abs(j-self.kp) < 2:
+            return mvv_lva[p, 'K']
+        if p == 'P':
+            if A8 <= j <= H8:
+                return mvv_lva[p, 'Q']
+            if j == self.ep:
+                return mvv_lva[p, 'P']
+        return 0
+
+    def in_check(self):
+        ''' Whether the opponent attacks our king '''
+        return least_attacker(self.board, self.board.index('K'), False) is not None
+
+    def see(self, move):
+        ''' Static exchange evaluation: the material won by move, if both sides
+        then keep recapturing on its square with their least valuable piece,
+        each side stopping when that's better for it. '''
+        i, j = move
+        p, q = self.board[i], self.board[j]
+        # Moving next to where a king castled is capturing the king
+        if abs(j-self.kp) < 2:
+            return init_piece['K']
+        board = list(self.board)
+        board[i] = '.'
+        gain = [init_piece.get(q.upper(), 0)]
+        last = init_piece[p]
+        if p == 'P':
+            if j == self.ep:
+                gain[0] = init_piece['P']
+                board[j+S] = '.'
+            if A8 <= j <= H8:
+                gain[0] += init_piece['Q'] - init_piece['P']
+                last = init_piece['Q']
+        # Removing each capturer from the board also uncovers its x-rays
+        upper = False
+        while True:
+            attacker = least_attacker(board, j, upper)
+            if attacker is None: break
+            k, r = attacker
+            gain.append(last - gain[-1])
+            board[k] = '.'
+            last = init_piece[r.upper()]
+            upper = not upper
+        # Back up the scores, each capture being optional
+        while len(gain) > 1:
+            score = gain.pop()
+            gain[-1] = min(gain[-1], -score)
+        return gain[0]
+
+def least_attacker(board, j, upper):
+    ''' The square and piece of the least valuable piece attacking square j on
+    a 120 char board, of the upper case side if upper. None if there is none. '''
+    if upper:
+        pawns, knight = (j+S+W, j+S+E), 'N'
+    else:
+        pawns, knight = (j+N+W, j+N+E), 'n'
+    for k in pawns:
+        if board[k] == ('P' if upper else 'p'):
+            return k, board[k]
+    for d in directions['N']:
+        if board[j+d] == knight:
+            return j+d, knight
+    # The first piece on each ray, if it is ours and moves along the ray
+    best, best_k = None, None
+    for d in directions['Q']:
+        k = j+d
+        while board[k] == '.': k += d
+        r = board[k]
+        if not r.isalpha() or r.isupper() != upper: continue
+        r = r.upper()
+        if r == 'Q' or r == ('R' if d in directions['R'] else 'B') or r == 'K' and k == j+d:
+            if best is None or init_piece[r] < init_piece[best]:
+                best, best_k = r, k
+    if best is None:
+        return None
+    return best_k, board[best_k]
+
+def pawn_structure(board):
+    ''' The pawn structure score of a board, for the side to move. It only
+    depends on the pawns, so it is cached by pawn_hash, see PawnTable. '''
+    ours = [i for i, p in enumerate(board) if p == 'P']
+    theirs = [i for i, p in enumerate(board) if p == 'p']
+    return _pawns(ours, theirs) - _pawns([119-i for i in theirs], [119-i for i in ours])
+
+def _pawns(ours, theirs):
+    ''' The pawn structure score of the pawns ours, with the opponent's pawns
+    theirs on the same board. '''
+    files = [0]*10
+    for i in ours: files[i%10] += 1
+    score = 0
+    for i in ours:
+        f = i % 10
+        if files[f] > 1: score += DOUBLED_PAWN
+        if not files[f-1] and not files[f+1]: score += ISOLATED_PAWN
+        # Passed, if no opponent pawn is ahead on this or a neighbouring file
+        if not any(j//10 < i//10 and abs(j%10 - f) <= 1 for j in theirs):
+            score += passed_pawn[i//10]
+    return score
+
+class MutablePosition:
+    """ A position that is changed in place by make_move and restored by
+    unmake_move, so a search can run on a single board without allocating a
+    new Position per node. It has the attributes of Position, except that
+    board is a list. A second list keeps the board as seen by the opponent, so
+    turning the board is just a swap of the two.
+    move and nullmove return immutable Positions, for the few places that look
+    ahead without searching.
+    """
+
+    piece = Position.piece
+    gen_moves = Position.gen_moves
+    gen_captures = Position.gen_captures
+    value = Position.value
+    evaluate = Position.evaluate
+    mvv_lva = Position.mvv_lva
+    in_check = Position.in_check
+    see = Position.see
+
+    def __init__(self, pos):
+        self.board = list(pos.board)
+        self.other = list(pos.board[::-1].swapcase())
+        self.score = pos.score
+        self.wc = pos.wc
+        self.bc = pos.bc
+        self.ep = pos.ep
+        self.kp = pos.kp
+        self.pst = pos.pst
+        self.pst_taper = pos.pst_taper
+        self.hash = pos.hash
+        self.taper = pos.taper
+        self.phase = pos.phase
+        self.material = pos.material
+        self.pawn_hash = pos.pawn_hash
+        self.stack = []
+
+    def position(self):
+        ''' An immutable copy of the current position '''
+        return Position(''.join(self.board), self.score, self.wc, self.bc,
+                        self.ep, self.kp, self.pst, self.hash,
+                        self.taper, self.phase, self.material, self.pawn_hash,
+                        self.pst_taper)
+
+    def move(self, move):
+        return self.position().move(move)
+
+    def nullmove(self):
+        return self.position().nullmove()
+
+    def make_move(self, move):
+        ''' Plays the move, or the null move if None, and turns the board '''
+        board, other = self.board, self.other
+        wc, bc, ep, kp, score = self.wc, self.bc, 0, 0, self.score
+        taper, phase, material = self.taper, self.phase, self.material
+        pawn_hash = self.pawn_hash
+        hash = self.hash ^ zobrist_ep[self.ep] ^ zobrist_kp[self.kp]
+        # The squares changed, with their old pieces, for unmake_move
+        changes = ()
+        if move is not None:
+            i, j = move
+            p, q = board[i], board[j]
+            score += self.value(move)
+            if p in 'PK' or q in 'pk' or abs(j-self.kp) < 2:
+                taper += self.value(move, self.pst_taper)
+            phase -= phase_weight[q]
+            material -= material_unit[q]
+            hash ^= zobrist_castle[wc, bc]
+            # Actual move
+            board[j], board[i] = p, '.'
+            other[119-j], other[119-i] = p.swapcase(), '.'
+            changes = [(j, q), (i, p)]
+            hash ^= zobrist[p][i] ^ zobrist[p][j] ^ zobrist[q][j]
+            pawn_hash ^= zobrist_pawn[p][i] ^ zobrist_pawn[p][j] ^ zobrist_pawn[q][j]
+            # Castling rights, we move the rook or capture the opponent's
+            if i == A1: wc = (False, wc[1])
+            if i == H1: wc = (wc[0], False)
+            if j == A8: bc = (bc[0], False)
+            if j == H8: bc = (False, bc[1])
+            # Castling
+            if p == 'K':
+                wc = (False, False)
+                if abs(j-i) == 2:
+                    kp, r = (i+j)//2, A1 if j < i else H1
+                    changes += [(r, board[r]), (kp, board[kp])]
+                    board[r], board[kp] = '.', 'R'
+                    other[119-r], other[119-kp] = '.', 'r'
+                    hash ^= zobrist['R'][r] ^ zobrist['R'][kp]
+            # Pawn promotion, double move and en passant capture
+            if p == 'P':
+                if A8 <= j <= H8:
+                    board[j], other[119-j] = 'Q', 'q'
+                    hash ^= zobrist['P'][j] ^ zobrist['Q'][j]
+                    pawn_hash ^= zobrist['P'][j]
+                    phase += phase_weight['Q']
+                    material += material_unit['Q'] - material_unit['P']
+                if j - i == 2*N:
+                    ep = i + N
+                if j - i in (N+W, N+E) and q == '.':
+                    changes.append((j+S, board[j+S]))
+                    board[j+S], other[119-(j+S)] = '.', '.'
+                    hash ^= zobrist['p'][j+S]
+                    pawn_hash ^= zobrist['p'][j+S]
+                    material -= material_unit['p']
+            hash ^= zobrist_castle[wc, bc] ^ zobrist_ep[ep] ^ zobrist_kp[kp]
+        self.stack.append((self.score, self.wc, self.bc, self.ep, self.kp, self.hash,
+                           self.taper, self.phase, self.material, self.pawn_hash,
+                           changes))
+        # Turn the board, so it's ready for the next player
+        self.board, self.other = other, board
+        self.score = -score
+        self.wc, self.bc = bc, wc
+        self.ep = 119-ep if ep else 0
+        self.kp = 119-kp if kp else 0
+        self.hash = zrotate(hash) ^ zobrist_side
+        self.taper, self.phase, self.material = -taper, phase, zrotate(material)
+        self.pawn_hash = zrotate(pawn_hash)
+
+    def unmake_move(self):
+        ''' Takes back the last make_move '''
+        (self.score, self.wc, self.bc, self.ep, self.kp, self.hash,
+         self.taper, self.phase, self.material, self.pawn_hash,
+         changes) = self.stack.pop()
+        board, other = self.other, self.board
+        self.board, self.other = board, other
+        for i, p in changes:
+            board[i] = p
+            other[119-i] = p.swapcase()
+
 ###############################################################################
 # Search logic
 ###############################################################################
 
-# lower <= s(pos) <= upper
-Entry = namedtuple('Entry', 'lower upper')
-
-# The normal OrderedDict doesn't update the position of a key in the list,
-# when the value is changed.
-class LRUCache:
-    '''Store items in the order the keys were last added'''
-    def __init__(self, size):
-        self.od = OrderedDict()
-        self.size = size
-
-    def get(self, key, default=None):
-        try: self.od.move_to_end(key)
-        except KeyError: return default
-        return self.od[key]
-
-    def __setitem__(self, key, value):
-        try: del self.od[key]
-        except KeyError:
-            if len(self.od) == self.size:
-                self.od.popitem(last=False)
-        self.od[key] = value
+# Moves are stored in the table by their squares on the 8x8 board
+sq64 = [(i//10-2)*8 + i%10-1 for i in range(120)]
+sq120 = [A8 + (k//8)*10 + k%8 for k in range(64)]
+
+class TranspositionTable:
+    """ A fixed size table of search results, preallocated as a flat array of
+    64 bit words. A slot is two words: the data, and the zobrist key xor'ed
+    with the data. The data packs the bounds lower <= s(pos) <= upper, the
+    depth (and root flag) searched, the best move and the age of the search.
+    A slot is only used if the key comes out right, so the table can live in
+    memory shared by several processes without locks: a slot torn by
+    concurrent writes looks like a miss.
+    Keys map to a bucket of two slots: the first is only replaced by deeper
+    searches or by entries from a newer search, the second is always replaced.
+    """
+
+    # Layout of the data word, from the low bits: 12 bits of move, 18 bits
+    # each for lower and upper (offset by MATE_UPPER), 11 bits of depth*2+root
+    # and 5 bits of age.
+
+    def __init__(self, mb=TABLE_SIZE, buffer=None):
+        """ buffer may be a writable buffer of at least TranspositionTable.bytes(mb)
+        bytes, such as multiprocessing.shared_memory.SharedMemory.buf """
+        self.buckets = max(1, int(mb * 2**20) // 32)
+        if buffer is None:
+            self.slots = array('Q', [0]) * (4*self.buckets)
+        else:
+            self.slots = buffer.cast('Q')[:4*self.buckets]
+        self.age = 0
+
+    @staticmethod
+    def bytes(mb):
+        return max(1, int(mb * 2**20) // 32) * 32
+
+    def new_search(self):
+        """ Entries from previous searches may be replaced by shallower ones """
+        self.age = (self.age + 1) % 32
+
+    def get(self, key, depth, root):
+        """ Returns the bounds (lower, upper) stored for the position """
+        d = 2*depth + root
+        slots = self.slots
+        a = key % self.buckets * 4
+        for i in (a, a+2):
+            data = slots[i+1]
+            if slots[i] ^ data == key and data >> 48 & 0x7ff == d:
+                return (data >> 12 & 0x3ffff) - MATE_UPPER, (data >> 30 & 0x3ffff) - MATE_UPPER
+        return -MATE_UPPER, MATE_UPPER
+
+    def get_move(self, key):
+        """ Returns the best move stored for the position, at any depth """
+        slots = self.slots
+        a = key % self.buckets * 4
+        for i in (a, a+2):
+            data = slots[i+1]
+            if slots[i] ^ data == key:
+                m = data & 0xfff
+                return (sq120[m >> 6], sq120[m & 63]) if m else None
+        return None
+
+    def put(self, key, depth, root, lower, upper, move=False):
+        """ Stores the bounds, and the move unless it is False. A move of None
+        means the null move was best. """
+        d = 2*depth + root
+        slots = self.slots
+        a = key % self.buckets * 4
+        b = a + 2
+        da, db = slots[a+1], slots[b+1]
+        ka, kb = slots[a] ^ da == key, slots[b] ^ db == key
+        if ka and da >> 48 & 0x7ff == d: i = a
+        elif kb and db >> 48 & 0x7ff == d: i = b
+        elif da >> 48 & 0x7ff <= d or da >> 59 != self.age: i = a
+        else: i = b
+        if move is False:
+            m = da & 0xfff if ka else db & 0xfff if kb else 0
+        else:
+            m = sq64[move[0]] << 6 | sq64[move[1]] if move else 0
+        # Keep the move of the other slot in sync, if it has the same position
+        if i == a and kb:
+            db = db & ~0xfff | m
+            slots[b], slots[b+1] = key ^ db, db
+        if i == b and ka:
+            da = da & ~0xfff | m
+            slots[a], slots[a+1] = key ^ da, da
+        data = self.age << 59 | d << 48 | (upper + MATE_UPPER) << 30 | (lower + MATE_UPPER) << 12 | m
+        slots[i], slots[i+1] = key ^ data, data
+
+class PawnTable:
+    """ A small table of pawn structure scores, by pawn_hash. Pawns move
+    rarely, so nearly all lookups hit. A slot holds the key and the score;
+    the empty slots have key 0, which is the key of no pawns at all, with
+    score 0, so they are correct as they are. """
+
+    def __init__(self, size=PAWN_TABLE_SIZE):
+        self.keys = array('Q', [0]) * size
+        self.scores = array('l', [0]) * size
+        self.hits = self.lookups = 0
+
+    def get(self, pos):
+        """ Returns pawn_structure(pos.board), computing it on a miss """
+        # The same pawns seen from the other side have the rotated key and
+        # the opposite score, so both are stored as the smaller key
+        key, sign = pos.pawn_hash, 1
+        rotated = zrotate(key)
+        if rotated < key:
+            key, sign = rotated, -1
+        i = key % len(self.keys)
+        self.lookups += 1
+        if self.keys[i] == key:
+            self.hits += 1
+            return sign * self.scores[i]
+        score = pawn_structure(pos.board)
+        self.keys[i], self.scores[i] = key, sign * score
+        return score
+
+class Stopped(Exception):
+    """ Raised by bound to unwind a search that should stop """
 
 class Searcher:
-    def __init__(self):
-        self.tp_score = LRUCache(TABLE_SIZE)
-        self.tp_move = LRUCache(TABLE_SIZE)
+    def __init__(self, table_size=TABLE_SIZE, make_unmake=False, table=None, pvs=False):
+        # The table may be given, e.g. one shared with other searchers
+        self.tp = table if table is not None else TranspositionTable(table_size)
         self.nodes = 0
+        # Search on a single MutablePosition rather than a Position per node
+        self.make_unmake = make_unmake
+        # Use principal variation search at the root, rather than MTD-bi
+        self.pvs = pvs
+        # Quiet moves that caused cutoffs, two per ply, as 120*i+j
+        self.killers = array('H', [0]) * (2*MAX_DEPTH)
+        # Butterfly history, indexed by 120*'PNBRQK'.index(piece) + j
+        self.history = array('l', [0]) * (6*120)
+        self.ply = 0
+        self.pawns = PawnTable()
+        # Endgame tablebases, like tablebase.Tablebases, or None
+        self.tablebase = None
+        # A function, or None. When it returns True the search stops in the
+        # middle of a depth, e.g. at a deadline or when another thread says so.
+        self.should_stop = None
 
     def bound(self, pos, gamma, depth, root=True):
         """ returns r where
                 s(pos) <= r < gamma    if gamma > s(pos)
                 gamma <= r <= s(pos)   if gamma <= s(pos)"""
         self.nodes += 1
+        if self.nodes % STOP_NODES == 0 and self.should_stop is not None and self.should_stop():
+            raise Stopped()
 
         # Depth <= 0 is QSearch. Here any position is searched as deeply as is needed for calmness, and so there is no reason to keep different depths in the transposition table.
         depth = max(depth, 0)
@@ -280,43 +862,71 @@ class Searcher:
         if pos.score <= -MATE_LOWER:
             return -MATE_UPPER
 
+        # The scores of tablebase positions are exact, at any depth
+        if self.tablebase is not None and not root:
+            score = self.tablebase.probe(pos)
+            if score is not None:
+                return score
+
         # Look in the table if we have already searched this position before.
         # We also need to be sure, that the stored search was over the same
         # nodes as the current search.
-        entry = self.tp_score.get((pos, depth, root), Entry(-MATE_UPPER, MATE_UPPER))
-        if entry.lower >= gamma and (not root or self.tp_move.get(pos) is not None):
-            return entry.lower
-        if entry.upper < gamma:
-            return entry.upper
+        lower, upper = self.tp.get(pos.hash, depth, root)
+        if lower >= gamma and (not root or self.tp.get_move(pos.hash) is not None):
+            return lower
+        if upper < gamma:
+            return upper
 
         # Here extensions may be added
         # Such as 'if in_check: depth += 1'
 
+        # Neither futility pruning nor late move reductions are used at the
+        # root, near mate scores or when in check
+        prune = depth > 0 and not root and abs(gamma) < MATE_LOWER and not pos.in_check()
+
+        # Futility pruning. Near the leaves we trust the score to be within a
+        # margin of what the search would find, unless mates are involved.
+        futile = prune and depth <= FUTILITY_DEPTH
+        if futile:
+            static = pos.evaluate(self.pawns)
+            if static - REVERSE_FUTILITY_MARGIN*depth >= gamma:
+                return static - REVERSE_FUTILITY_MARGIN*depth
+            futile = static + FUTILITY_MARGIN*depth < gamma
+
         # Generator of moves to search in order.
         # This allows us to define the moves, but only calculate them if needed.
         def moves():
+            reduce = prune and depth >= LMR_DEPTH
+            killers = self.killers[2*self.ply:2*self.ply+2]
             # First try not moving at all
             if depth > 0 and not root and any(c in pos.board for c in 'RBNQ'):
-                yield None, -self.bound(pos.nullmove(), 1-gamma, depth-3, root=False)
+                yield None, -self.child(pos, None, 1-gamma, depth-3)
             # For QSearch we have a different kind of null-move
             if depth == 0:
-                yield None, pos.score
-            # Then killer move. We search it twice, but the tp will fix things for us. Note, we don't have to check for legality, since we've already done it before. Also note that in QS the killer must be a capture, otherwise we will be non deterministic.
-            killer = self.tp_move.get(pos)
-            if killer and (depth > 0 or pos.value(killer) >= QS_LIMIT):
-                yield killer, -self.bound(pos.move(killer), 1-gamma, depth-1, root=False)
-            # Then all the other moves
-            for move in sorted(pos.gen_moves(), key=pos.value, reverse=True):
-                if depth > 0 or pos.value(move) >= QS_LIMIT:
-                    yield move, -self.bound(pos.move(move), 1-gamma, depth-1, root=False)
+                yield None, pos.evaluate(self.pawns)
+            for k, move in enumerate(self.ordered_moves(pos, depth)):
+                late = reduce and k >= LMR_MOVES and 120*move[0]+move[1] not in killers
+                if k > 0 and (futile or late) and not pos.mvv_lva(move):
+                    # Futile quiet moves are assumed to fail low
+                    if futile:
+                        yield move, static + FUTILITY_MARGIN*depth
+                        continue
+                    # Late quiet moves only get a full search if they fail high
+                    score = -self.child(pos, move, 1-gamma, depth-1-LMR_REDUCTION)
+                    if score < gamma:
+                        yield move, score
+                        continue
+                yield move, -self.child(pos, move, 1-gamma, depth-1)
 
         # Run through the moves, shortcutting when possible
-        best = -MATE_UPPER
+        best, best_move = -MATE_UPPER, False
         for move, score in moves():
             best = max(best, score)
             if best >= gamma:
                 # Save the move for pv construction and killer heuristic
-                self.tp_move[pos] = move
+                best_move = move
+                if depth > 0 and move is not None and not pos.mvv_lva(move):
+                    self.update_killers(pos, move, depth)
                 break
 
         # Stalemate checking is a bit tricky: Say we failed low, because
@@ -337,49 +947,206 @@ class Searcher:
 
         # Table part 2
         if best >= gamma:
-            self.tp_score[(pos, depth, root)] = Entry(best, entry.upper)
+            self.tp.put(pos.hash, depth, root, best, upper, best_move)
         if best < gamma:
-            self.tp_score[(pos, depth, root)] = Entry(entry.lower, best)
+            self.tp.put(pos.hash, depth, root, lower, best)
 
         return best
 
+    def ordered_moves(self, pos, depth):
+        ''' Yields the moves of pos to search, in order. The moves are picked in
+        stages, and each stage is only computed if the previous ones didn't
+        produce a cutoff. At depth 0 only captures are yielded. '''
+        # First the killer move. We search it twice, but the tp will fix things for us. Note, we don't have to check for legality, since we've already done it before. Also note that in QS the killer must be a capture, otherwise we will be non deterministic.
+        killer = self.tp.get_move(pos.hash)
+        if killer and (depth > 0 or pos.value(killer) >= QS_LIMIT):
+            yield killer
+        # Then captures and promotions, by mvv/lva. In QSearch that's all,
+        # so there we never generate the quiet moves.
+        captures = [(pos.mvv_lva(move), move) for move in pos.gen_captures()]
+        captures.sort(reverse=True)
+        # Captures that lose material by static exchange are pruned in
+        # QSearch, and otherwise tried after the quiet moves.
+        losing = []
+        for key, move in captures:
+            if depth > 0 or pos.value(move) >= QS_LIMIT:
+                if key not in safe_captures and pos.see(move) < 0:
+                    losing.append(move)
+                    continue
+                yield move
+        if depth == 0:
+            return
+        # The quiet moves are only generated once the captures didn't cut off
+        quiets = [move for move in pos.gen_moves() if not pos.mvv_lva(move)]
+        # Then the killers, if they are legal here
+        for k in (2*self.ply, 2*self.ply+1):
+            move = divmod(self.killers[k], 120)
+            if move in quiets:
+                quiets.remove(move)
+                yield move
+        # Then the other quiet moves, by history and then by value
+        history = self.history
+        key = lambda move: (history[120*'PNBRQK'.index(pos.piece(move[0])) + move[1]], pos.value(move))
+        for move in sorted(quiets, key=key, reverse=True):
+            yield move
+        for move in losing:
+            yield move
+
+    def child(self, pos, move, gamma, depth):
+        ''' The bound of the position after move, None being the null move '''
+        self.ply += 1
+        if not self.make_unmake:
+            child = pos.nullmove() if move is None else pos.move(move)
+            score = self.bound(child, gamma, depth, root=False)
+        else:
+            pos.make_move(move)
+            try:
+                score = self.bound(pos, gamma, depth, root=False)
+            finally:
+                pos.unmake_move()
+        self.ply -= 1
+        return score
+
+    def update_killers(self, pos, move, depth):
+        ''' Remember a quiet move that caused a cutoff '''
+        i, j = move
+        k = 2*self.ply
+        if self.killers[k] != 120*i+j:
+            self.killers[k+1] = self.killers[k]
+            self.killers[k] = 120*i+j
+        self.history[120*'PNBRQK'.index(pos.piece(i)) + j] += depth*depth
+
     # secs over maxn is a breaking change. Can we do this?
     # I guess I could send a pull request to deep pink
     # Why include secs at all?
-    def _search(self, pos):
-        """ Iterative deepening MTD-bi search """
+    def _search(self, pos, first_depth=1):
+        """ Iterative deepening MTD-bi search, or PVS if self.pvs. If
+        should_stop stops it, the generator ends with the result of the last
+        full depth in the table. The first depth is always finished, so there
+        is a move to play. """
         self.nodes = 0
+        self.ply = 0
+        # Killers are by ply, so they don't carry over from the last search
+        self.killers = array('H', [0]) * (2*MAX_DEPTH)
+        self.tp.new_search()
+        key = pos.hash
+        if self.make_unmake:
+            pos = MutablePosition(pos)
+
+        # In a tablebase ending the best move is known without searching
+        if self.tablebase is not None:
+            best = self.tablebase.best_move(pos)
+            if best is not None:
+                self.depth = first_depth
+                move, score = best
+                self.tp.put(pos.hash, first_depth, True, score, score, move)
+                yield
+                return
 
         # In finished games, we could potentially go far enough to cause a recursion
         # limit exception. Hence we bound the ply.
-        for depth in range(1, 1000):
+        score = 0
+        should_stop, self.should_stop = self.should_stop, None
+        for depth in range(first_depth, MAX_DEPTH):
             self.depth = depth
-            # The inner loop is a binary search on the score of the position.
-            # Inv: lower <= score <= upper
-            # 'while lower != upper' would work, but play tests show a margin of 20 plays better.
-            lower, upper = -MATE_UPPER, MATE_UPPER
-            while lower < upper - EVAL_ROUGHNESS:
-                gamma = (lower+upper+1)//2
-                score = self.bound(pos, gamma, depth)
-                if score >= gamma:
-                    lower = score
-                if score < gamma:
-                    upper = score
-            # We want to make sure the move to play hasn't been kicked out of the table,
-            # So we make another call that must always fail high and thus produce a move.
-            score = self.bound(pos, lower, depth)
+            # Age the history, so the last iteration counts the most
+            self.history = array('l', (h // 2 for h in self.history))
+            try:
+                if self.pvs:
+                    score = self.pvs_root(pos, depth, score)
+                else:
+                    score = self.mtd_root(pos, depth)
+            except Stopped:
+                # The unfinished depth may have left any move that failed
+                # high at the root, so the last full depth is put back
+                self.depth = depth - 1
+                self.tp.put(key, depth-1, True, lower, upper, move)
+                return
+            lower, upper = self.tp.get(key, depth, True)
+            move = self.tp.get_move(key)
+            self.should_stop = should_stop
 
             # Yield so the user may inspect the search
             yield
 
+    def mtd_bi(self, bound, lower, upper):
+        """ Binary search for a score known to be in [lower, upper], using
+        bound(gamma), a null window search around gamma, until the interval
+        is narrower than EVAL_ROUGHNESS. Returns the final interval. """
+        # Inv: lower <= score <= upper
+        # 'while lower != upper' would work, but play tests show a margin of 20 plays better.
+        while lower < upper - EVAL_ROUGHNESS:
+            gamma = (lower+upper+1)//2
+            score = bound(gamma)
+            if score >= gamma:
+                lower = score
+            if score < gamma:
+                upper = score
+        return lower, upper
+
+    def mtd_root(self, pos, depth):
+        """ MTD-bi, a binary search on the score of the position """
+        lower, upper = self.mtd_bi(lambda gamma: self.bound(pos, gamma, depth),
+                                   -MATE_UPPER, MATE_UPPER)
+        # We want to make sure the move to play hasn't been kicked out of the table,
+        # So we make another call that must always fail high and thus produce a move.
+        # The pruning makes the search a little unstable, so it may fail low
+        # after all, in which case we try again at the bound it returned.
+        score = self.bound(pos, lower, depth)
+        while score < lower:
+            lower = score
+            score = self.bound(pos, lower, depth)
+        return lower
+
+    def pvs_root(self, pos, depth, guess):
+        """ Principal variation search at the root. The first move gets an
+        exact score, searching near guess first. The others are only searched
+        with a null window to show they are no better, unless they are. """
+        best, best_move = -MATE_UPPER, None
+        seen = set()
+        for move in self.ordered_moves(pos, depth):
+            # The killer is also generated again
+            if move in seen: continue
+            seen.add(move)
+            bound = lambda gamma: -self.child(pos, move, 1-gamma, depth-1)
+            if best_move is None:
+                lower, upper = self.aspiration(bound, guess)
+            else:
+                score = bound(best+1)
+                if score <= best: continue
+                lower, upper = self.mtd_bi(bound, score, MATE_UPPER)
+            best, best_move = lower, move
+        # When mated or stalemated, bound knows how to tell which
+        if best <= -MATE_LOWER:
+            return self.mtd_root(pos, depth)
+        self.tp.put(pos.hash, depth, True, best, best, best_move)
+        return best
+
+    def aspiration(self, bound, guess):
+        """ Like mtd_bi, but first trying the edges of a window around guess,
+        since the score usually changes little between iterations """
+        lower, upper = -MATE_UPPER, MATE_UPPER
+        for gamma in (guess - ASPIRATION_WINDOW, guess + ASPIRATION_WINDOW):
+            if not lower < gamma <= upper: continue
+            score = bound(gamma)
+            if score >= gamma:
+                lower = score
+            if score < gamma:
+                upper = score
+        return self.mtd_bi(bound, lower, upper)
+
     def search(self, pos, secs):
+        """ Searches for secs seconds, stopping in the middle of a depth if
+        need be """
         start = time.time()
+        self.should_stop = lambda: time.time() - start > secs
         for _ in self._search(pos):
             if time.time() - start > secs:
                 break
+        self.should_stop = None
         # If the game hasn't finished we can retrieve our move from the
         # transposition table.
-        return self.tp_move.get(pos), self.tp_score.get((pos, self.depth, True)).lower
+        return self.tp.get_move(pos.hash), self.tp.get(pos.hash, self.depth, True)[0]
 
 
 ###############################################################################
@@ -389,11 +1156,6 @@ class Searcher:
 # Python 2 compatability
 if sys.version_info[0] == 2:
     input = raw_input
-    class NewOrderedDict(OrderedDict):
-        def move_to_end(self, key):
-            value = self.pop(key)
-            self[key] = value
-    OrderedDict = NewOrderedDict
 
 
 def parse(c):
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import os
+import mmap
+import time
+import argparse
+
+import sunfish
+from sunfish import MATE_UPPER, S, sq64, material_unit
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+###############################################################################
+# Endgame tablebases. A table holds the distance to mate of every position of
+# a material, like KQvK, with the side of the first pieces to move. The
+# squares of the pieces, in the order of the name and as seen by the side to
+# move, index the table: ours in sunfish.sq64 order, six bits each, the first
+# piece in the highest bits. Each position has a byte:
+#
+#     n+1     the side to move mates in n plies, 1 if it can take the king
+#     -(n+1)  the side to move is mated in n plies, -1 if it is checkmated
+#     0       a draw, or no position at all, like two pieces on one square
+#
+# Castling, en passant and the fifty move rule are left out, and pawns only
+# promote to queens, as in sunfish.
+#
+# Tables are generated by retrograde analysis, from the positions that are
+# mate back to the ones that lead to them, so generating needs NumPy, while
+# probing only maps the files into memory.
+###############################################################################
+
+TABLEBASES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tablebases')
+EXT = '.dtm'
+
+# The order of the pieces of a side in the name of a table
+PIECES = 'KQRBNP'
+
+
+def _side(pieces):
+    return ''.join(sorted(pieces.upper(), key=PIECES.index))
+
+
+def table_name(ours, theirs):
+    ''' The name of the table of the pieces of each side, with ours to move '''
+    return _side(ours) + 'v' + _side(theirs)
+
+
+def _pieces(name):
+    ''' The pieces of a table, in index order, ours uppercase '''
+    ours, theirs = name.split('v')
+    return ours + theirs.lower()
+
+
+def _score(v):
+    ''' The score of a table byte, in the terms of Searcher.bound '''
+    if v > 127:
+        v -= 256
+    if v > 0:
+        return MATE_UPPER - v + 1
+    if v < 0:
+        return -MATE_UPPER - v - 1
+    return 0
+
+
+class Tablebases:
+    ''' The tables of a folder, memory mapped, by the material of their
+    positions. A Searcher uses any object with the probe and best_move of
+    this class as its tablebase. '''
+
+    def __init__(self, path=TABLEBASES):
+        self.path = path
+        self.tables = {}
+        self.files = []
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(EXT):
+                continue
+            f = open(os.path.join(path, name), 'rb')
+            pieces = _pieces(name[:-len(EXT)])
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.tables[sum(material_unit[p] for p in pieces)] = (pieces, data)
+            self.files.append(f)
+
+    def __len__(self):
+        return len(self.tables)
+
+    def close(self):
+        for _, data in self.tables.values():
+            data.close()
+        for f in self.files:
+            f.close()
+
+    def probe(self, pos):
+        ''' The exact score of pos, or None if it isn't in the tables '''
+        table = self.tables.get(pos.material)
+        if table is None:
+            return None
+        board = pos.board
+        if pos.kp or any(pos.wc) and 'R' in board or any(pos.bc) and 'r' in board:
+            return None
+        if pos.ep and 'P' in (board[pos.ep+S-1], board[pos.ep+S+1]):
+            return None
+        pieces, data = table
+        index, i, last = 0, 0, None
+        for p in pieces:
+            # A second piece of a kind is found after the first
+            i = board.index(p, i+1 if p == last else 0)
+            index = index << 6 | sq64[i]
+            last = p
+        return _score(data[index])
+
+    def best_move(self, pos):
+        ''' The best move of pos and its score, or None if the tables don't
+        hold all the positions it leads to, or if there is no legal move '''
+        best = None
+        for move in pos.gen_moves():
+            score = self.probe(pos.move(move))
+            if score is None:
+                return None
+            if best is None or -score > best[1]:
+                best = move, -score
+        if best is None or best[1] == -MATE_UPPER:
+            return None
+        # The mate is a ply further away from here
+        move, score = best
+        return move, score - 1 if score > 0 else score + 1 if score < 0 else 0
+
+
+def load(path=TABLEBASES):
+    ''' The tablebases of path, or None if there are none '''
+    if not os.path.isdir(path):
+        return None
+    tablebases = Tablebases(path)
+    return tablebases if len(tablebases) else None
+
+
+###############################################################################
+# Generation
+###############################################################################
+
+INF = 1 << 14
+# Positions are generated this many at a time, to bound the memory
+CHUNK = 1 << 18
+
+if np is not None:
+    _onboard = np.array([not c.isspace() for c in sunfish.initial])
+    _sq120 = np.array(sunfish.sq120)
+    # The square as seen by the opponent, 0 off the board
+    _rot64 = np.where(_onboard, 63 - np.array(sq64), 0)
+    # By the difference of two squares, offset by 119: whether a knight or a
+    # king moves that way, and the step of a bishop or rook line along it
+    _leaps = {p: np.zeros(239, dtype=bool) for p in 'NK'}
+    _lines = {p: np.zeros(239, dtype=int) for p in 'BRQ'}
+    for _p in 'NK':
+        _leaps[_p][[d + 119 for d in sunfish.directions[_p]]] = True
+    for _p in 'BR':
+        for _d in sunfish.directions[_p]:
+            _lines[_p][[k*_d + 119 for k in range(1, 8)]] = _d
+    _lines['Q'] = _lines['B'] + _lines['R']
+
+
+def _attacked(t, attackers, blockers):
+    ''' Whether square t is attacked by any of attackers, (piece, squares)
+    pairs with our pieces uppercase, with blockers the squares of all the
+    pieces. Arrays are of one square per position. '''
+    hit = np.zeros(len(t), dtype=bool)
+    for p, a in attackers:
+        d = t - a
+        if p == 'P':
+            hit |= (d == -9) | (d == -11)
+        elif p == 'p':
+            hit |= (d == 9) | (d == 11)
+        elif p.upper() in 'NK':
+            hit |= _leaps[p.upper()][d + 119]
+        else:
+            step = _lines[p.upper()][d + 119]
+            # The line must not run off the side of the board
+            files = (step + 5) % 10 - 5
+            free = (step != 0) & (t % 10 - a % 10 == d // np.where(step, step, 1) * files)
+            for b in blockers:
+                db = b - a
+                free &= (_lines['Q'][db + 119] != step) | (np.abs(db) >= np.abs(d))
+            hit |= free
+    return hit
+
+
+def _slide(p, s, squares):
+    ''' Yields (t, mask, occupant) for the squares t a piece p on s could go
+    to, with mask where t is on the board and reached, and occupant the
+    index of the piece on t, or -1 '''
+    for d in sunfish.directions[p.upper()]:
+        alive = np.ones(len(s), dtype=bool)
+        t = s
+        for _ in range(7 if p.upper() in 'BRQ' else 1):
+            t = np.clip(t + d, 0, 119)
+            alive &= _onboard[t]
+            occupant = _occupant(t, squares)
+            yield t, alive, occupant
+            alive = alive & (occupant == -1)
+
+
+def _occupant(t, squares):
+    occupant = np.full(len(t), -1)
+    for k, sq in enumerate(squares):
+        occupant[sq == t] = k
+    return occupant
+
+
+def _perm(src, dst):
+    ''' For each piece of dst, the index of the same piece in src, where the
+    board of dst is that of src turned around '''
+    used, perm = set(), []
+    for c in dst:
+        k = next(k for k, p in enumerate(src) if p == c.swapcase() and k not in used)
+        used.add(k)
+        perm.append(k)
+    return perm
+
+
+def _index(squares, perm):
+    ''' The indices, in the table of perm, of the positions of squares seen
+    from the other side '''
+    index = 0
+    for k in perm:
+        index = index << 6 | _rot64[squares[k]]
+    return index
+
+
+class _Table:
+    def __init__(self, name):
+        self.name = name
+        self.pieces = _pieces(name)
+        self.n = len(self.pieces)
+        self.size = 64 ** self.n
+        ours, theirs = name.split('v')
+        self.partner = table_name(theirs, ours)
+
+    def squares(self, index):
+        return [_sq120[index >> 6*(self.n-1-k) & 63] for k in range(self.n)]
+
+
+class _Generator:
+    ''' Generates a table and its partner, with the other side to move, from
+    the tables of path for the materials they lead to '''
+
+    def __init__(self, name, path):
+        self.path = path
+        self.tables = [_Table(name)]
+        if self.tables[0].partner != name:
+            self.tables.append(_Table(self.tables[0].partner))
+        self.by_name = {t.name: t for t in self.tables}
+        self.values = {}
+
+    def exit_values(self, name):
+        if name not in self.values:
+            self.values[name] = np.fromfile(os.path.join(self.path, name + EXT), dtype=np.int8)
+        return self.values[name]
+
+    def forward(self, table, squares):
+        ''' Yields (mask, name, index) for the legal moves of the positions of
+        squares, with name the table the move leads to and index the position
+        there. A mask may be empty. '''
+        pieces = table.pieces
+        ours = [k for k, p in enumerate(pieces) if p.isupper()]
+        theirs = [k for k, p in enumerate(pieces) if p.islower()]
+        for m in ours:
+            p, s = pieces[m], squares[m]
+            moves = []
+            if p == 'P':
+                occupant = _occupant(s-10, squares)
+                moves.append((s-10, occupant == -1, None))
+                double = (s // 10 == 8) & (occupant == -1)
+                moves.append((s-20, double & (_occupant(s-20, squares) == -1), None))
+                for t in (s-9, s-11):
+                    occupant = _occupant(t, squares)
+                    for c in theirs:
+                        moves.append((t, _onboard[t] & (occupant == c), c))
+            else:
+                for t, mask, occupant in _slide(p, s, squares):
+                    moves.append((t, mask & (occupant == -1), None))
+                    for c in theirs:
+                        moves.append((t, mask & (occupant == c), c))
+            for t, mask, c in moves:
+                if not mask.any():
+                    continue
+                after = list(squares)
+                after[m] = t
+                left = [k for k in range(table.n) if k != c]
+                king = after[0]
+                attackers = [(pieces[k], after[k]) for k in theirs if k != c]
+                mask = mask & ~_attacked(king, attackers, [after[k] for k in left])
+                if p == 'P':
+                    promote = t // 10 == 2
+                    for promoted in (False, True):
+                        yield self._successor(table, after, left, m, c, promoted,
+                                              mask & (promote == promoted))
+                else:
+                    yield self._successor(table, after, left, m, c, False, mask)
+
+    def _successor(self, table, after, left, m, c, promoted, mask):
+        pieces = list(table.pieces)
+        if promoted:
+            pieces[m] = 'Q'
+        pieces = [pieces[k] for k in left]
+        name = table_name(''.join(p for p in pieces if p.islower()),
+                          ''.join(p for p in pieces if p.isupper()))
+        perm = _perm(pieces, _pieces(name))
+        return mask, name, _index([after[k] for k in left], perm)
+
+    def backward(self, table, squares):
+        ''' Yields the indices, in the partner table, of the positions the
+        positions of squares are reached from by a move that isn't a capture
+        or a promotion '''
+        pieces = table.pieces
+        perm = _perm(pieces, _pieces(table.partner))
+        for m, p in enumerate(pieces):
+            if not p.islower():
+                continue
+            s = squares[m]
+            moves = []
+            if p == 'p':
+                # Their pawns move down the board
+                empty = (_occupant(s-10, squares) == -1) & (s-10 > sunfish.H8)
+                moves.append((s-10, empty))
+                double = (s // 10 == 5) & empty
+                moves.append((s-20, double & (_occupant(s-20, squares) == -1)))
+            else:
+                for t, mask, occupant in _slide(p, s, squares):
+                    moves.append((t, mask & (occupant == -1)))
+            for t, mask in moves:
+                before = list(squares)
+                before[m] = t
+                yield _index(before, perm)[mask]
+
+    def generate(self, verbose=True):
+        start = time.time()
+        for table in self.tables:
+            self.initialize(table)
+        top = max(max(int(t.win[t.win < INF].max(initial=0)), int(t.loss.max())) for t in self.tables)
+        d = 0
+        while d <= top:
+            for table in self.tables:
+                partner = self.by_name[table.partner]
+                # A move to a lost position wins
+                lost = np.flatnonzero(table.loss == d)
+                for chunk in range(0, len(lost), CHUNK):
+                    index = lost[chunk:chunk+CHUNK]
+                    for before in self.backward(table, table.squares(index)):
+                        before = before[partner.valid[before]]
+                        partner.win[before] = np.minimum(partner.win[before], d+1)
+                        if len(before):
+                            top = max(top, d+1)
+                # A position is lost once all its moves lead to won positions
+                won = np.flatnonzero(table.win == d)
+                for chunk in range(0, len(won), CHUNK):
+                    index = won[chunk:chunk+CHUNK]
+                    for before in self.backward(table, table.squares(index)):
+                        before, n = np.unique(before[partner.valid[before]], return_counts=True)
+                        partner.count[before] -= n.astype(np.uint8)
+                        mated = before[(partner.count[before] == 0) & (partner.win[before] == INF)
+                                       & ~partner.draw[before]]
+                        partner.loss[mated] = np.maximum(partner.exit_loss[mated], d+1)
+                        if len(mated):
+                            top = max(top, int(partner.loss[mated].max()))
+            d += 1
+        for table in self.tables:
+            self.save(table)
+            if verbose:
+                print('{}: {} positions, longest mate {} plies ({:.1f}s)'.format(
+                    table.name, int(table.valid.sum()),
+                    max(int(table.win[table.win < INF].max(initial=0)), int(table.loss.max())),
+                    time.time() - start))
+
+    def initialize(self, table):
+        ''' Finds the legal positions and counts their moves in the table,
+        and scores them by their moves to other tables '''
+        size = table.size
+        table.valid = np.zeros(size, dtype=bool)
+        table.illegal = np.zeros(size, dtype=bool)
+        table.count = np.zeros(size, dtype=np.uint8)
+        table.win = np.full(size, INF, dtype=np.int16)
+        table.loss = np.full(size, -1, dtype=np.int16)
+        table.exit_loss = np.full(size, -1, dtype=np.int16)
+        table.draw = np.zeros(size, dtype=bool)
+        pieces = table.pieces
+        ours = [k for k, p in enumerate(pieces) if p.isupper()]
+        theirs = [k for k, p in enumerate(pieces) if p.islower()]
+        for chunk in range(0, size, CHUNK):
+            index = np.arange(chunk, min(chunk+CHUNK, size))
+            squares = table.squares(index)
+            ok = np.ones(len(index), dtype=bool)
+            for k in range(table.n):
+                for l in range(k):
+                    ok &= squares[k] != squares[l]
+                if pieces[k] in 'Pp':
+                    ok &= (squares[k] // 10 >= 3) & (squares[k] // 10 <= 8)
+            # Positions where we can take their king aren't legal, but score
+            # as a win in 0 plies, which is what sunfish makes of them
+            takes = _attacked(squares[theirs[0]], [(pieces[k], squares[k]) for k in ours], squares)
+            table.illegal[index[ok & takes]] = True
+            ok &= ~takes
+            table.valid[index] = ok
+            index, squares = index[ok], [sq[ok] for sq in squares]
+            check = _attacked(squares[0], [(pieces[k], squares[k]) for k in theirs], squares)
+            count = np.zeros(len(index), dtype=int)
+            moves = np.zeros(len(index), dtype=int)
+            win = np.full(len(index), INF)
+            loss = np.full(len(index), -1)
+            draw = np.zeros(len(index), dtype=bool)
+            for mask, name, after in self.forward(table, squares):
+                moves += mask
+                if name in self.by_name:
+                    count += mask
+                    continue
+                v = self.exit_values(name)[np.where(mask, after, 0)]
+                win = np.where(mask & (v < 0), np.minimum(win, -v), win)
+                loss = np.where(mask & (v > 0), np.maximum(loss, v), loss)
+                draw |= mask & (v == 0)
+            table.count[index] = count
+            table.win[index] = win
+            table.exit_loss[index] = loss
+            # Stalemate is a draw, and checkmate is lost in 0 plies
+            table.draw[index] = draw | (moves == 0) & ~check
+            done = (count == 0) & (win == INF) & ~table.draw[index]
+            table.loss[index[done]] = np.where(moves[done] == 0, 0, loss[done])
+
+    def save(self, table):
+        assert max(int(table.win[table.win < INF].max(initial=0)), int(table.loss.max())) < 127
+        values = np.zeros(table.size, dtype=np.int8)
+        values[table.win < INF] = table.win[table.win < INF] + 1
+        values[table.loss >= 0] = -table.loss[table.loss >= 0] - 1
+        values[table.illegal] = 1
+        values.tofile(os.path.join(self.path, table.name + EXT))
+
+
+def _leads_to(name):
+    ''' The names of the tables the positions of name and its partner lead to
+    by captures and promotions '''
+    names = set()
+    ours, theirs = name.split('v')
+    for a, b in ((ours, theirs), (theirs, ours)):
+        for k, p in enumerate(b):
+            if p != 'K':
+                names.add(table_name(b[:k] + b[k+1:], a))
+        for k, p in enumerate(a):
+            if p == 'P':
+                promoted = a[:k] + 'Q' + a[k+1:]
+                names.add(table_name(b, promoted))
+                for l, q in enumerate(b):
+                    if q != 'K':
+                        names.add(table_name(b[:l] + b[l+1:], promoted))
+    return names
+
+
+def generate(name, path=TABLEBASES, verbose=True):
+    ''' Generates the table name, like KQvK, and its partner with the other
+    side to move, into the folder path. The tables they lead to are generated
+    first, unless they are already there. '''
+    if np is None:
+        raise ImportError('Generating tablebases needs NumPy')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    ours, theirs = name.split('v')
+    name = table_name(ours, theirs)
+    for other in sorted(_leads_to(name)):
+        if not os.path.exists(os.path.join(path, other + EXT)):
+            generate(other, path, verbose)
+    _Generator(name, path).generate(verbose)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate endgame tablebases, e.g. KQvK KRvK KPvK.')
+    parser.add_argument('names', nargs='+', help='tables to generate, like KQvK')
+    parser.add_argument('--path', default=TABLEBASES, help='folder of the tables')
+    args = parser.parse_args()
+    for name in args.names:
+        generate(name, args.path)
+
+
+if __name__ == '__main__':
+    main()
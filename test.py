@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
+import io
 import os
 import re
 import sys
@@ -13,11 +14,24 @@ import importlib
 import itertools
 import multiprocessing
 import random
+import shutil
+import tempfile
 import unittest
 import warnings
 
 import sunfish
 import tools
+import bitboard
+import parallel
+import Genetic
+import book
+import tablebase
+import timeman
+try:
+    import batch
+    import texel
+except ImportError:
+    batch = texel = None
 
 ###############################################################################
 # Playing test
@@ -66,15 +80,47 @@ class Tests(unittest.TestCase):
             msans = [msan for i, msan in enumerate(line.split()[:-1]) if i%3]
             pos = tools.parseFEN(tools.FEN_INITIAL)
             for i, msan in enumerate(msans):
-                move = tools.parseSAN(pos, msan)
                 if re.search('=[BNR]', msan):
                     # Sunfish doesn't support underpromotion
+                    self.assertRaises(ValueError, tools.parseSAN, pos, msan)
                     break
+                move = tools.parseSAN(pos, msan)
                 msan_back = tools.renderSAN(pos, move)
                 self.assertEqual(msan_back, msan,
                                  "Sunfish didn't correctly reproduce the SAN move")
                 pos = pos.move(move)
 
+    def test_pgn(self):
+        pgn_file = os.path.join(os.path.dirname(__file__), 'tests/pgns.pgn')
+        games = list(tools.readPGN(open(pgn_file)))
+        self.assertEqual(len(games), 278)
+        self.assertEqual([tags['Result'] for tags, _ in games],
+                         [line.split()[-1] for line in open(pgn_file)])
+        out = io.StringIO()
+        tools.writePGN(out, games)
+        again = list(tools.readPGN(io.StringIO(out.getvalue())))
+        self.assertEqual([moves for _, moves in again], [moves for _, moves in games])
+        self.assertEqual(again[0][0]['Date'], '????.??.??')
+        # Comments, variations and NAGs are skipped
+        pgn = ('[Event "x"]\n\n1. e4 {a} e5 {a longer\ncomment} (1... c5 (1... c6) 2. Nf3)\n'
+               '2. Nf3 $1 Nc6 ; Ruy Lopez\n3. Bb5 1/2-1/2\n'
+               '[FEN "' + tools.FEN_INITIAL + '"]\n\n1. Nf3 *\n')
+        (tags1, moves1), (tags2, moves2) = tools.readPGN(io.StringIO(pgn))
+        self.assertEqual(tags1, {'Event': 'x', 'Result': '1/2-1/2'})
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        for msan, move in zip('e4 e5 Nf3 Nc6 Bb5'.split(), moves1):
+            self.assertEqual(tools.renderSAN(pos, move), msan)
+            pos = pos.move(move)
+        self.assertEqual(len(moves1), 5)
+        self.assertEqual(moves2, [tools.mparse(tools.WHITE, 'g1f3')])
+        # Games are cut short at moves that can't be played
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        for msan in ('e5', 'exd3', 'e2'):
+            self.assertRaises(ValueError, tools.parseSAN, pos, msan)
+        pgn = '[FEN "8/P6k/8/8/8/8/8/K7 w - - 0 1"]\n\n1. a8=N Kg6 *\n'
+        (tags, moves), = tools.readPGN(io.StringIO(pgn))
+        self.assertEqual(moves, [])
+
     def test_selfplay(self):
         pos = tools.parseFEN(tools.FEN_INITIAL)
         for d in range(200):
@@ -100,6 +146,451 @@ class Tests(unittest.TestCase):
                 if p.islower(): score -= sunfish.pst[p.upper()][119-i]
             self.assertEqual(pos.rotate().score, score)
 
+    def test_bitboard(self):
+        for pos in self.positions:
+            bpos = bitboard.Position(pos.board, pos.score, pos.wc, pos.bc, pos.ep, pos.kp)
+            self.assertEqual(bpos.board, pos.board)
+            self.assertEqual(bpos, pos)
+            self.assertEqual(sorted(bpos.gen_moves()), sorted(pos.gen_moves()))
+            self.assertEqual(sorted(bpos.gen_captures()), sorted(pos.gen_captures()))
+            self.assertEqual(bpos.in_check(), pos.in_check())
+            for move in pos.gen_captures():
+                self.assertEqual(bpos.see(move), pos.see(move))
+            for move in pos.gen_moves():
+                self.assertEqual(bpos.value(move), pos.value(move))
+                self.assertEqual(bpos.mvv_lva(move), pos.mvv_lva(move))
+                pos1, bpos1 = pos.move(move), bpos.move(move)
+                self.assertEqual(bpos1.board, pos1.board)
+                self.assertEqual(bpos1.score, pos1.score)
+                self.assertEqual(bpos1, pos1)
+        success = allperft(open(self.perft_file), depth=2, verbose=False,
+                           position=bitboard.Position)
+        self.assertTrue(success)
+
+    def test_mvv_lva(self):
+        for pos in self.positions:
+            for move in pos.gen_moves():
+                # Captures, including of a king that just castled through check
+                if pos.board[move[1]].islower() or pos.value(move) >= sunfish.MATE_LOWER:
+                    self.assertGreater(pos.mvv_lva(move), 0)
+                elif pos.board[move[0]] != 'P':
+                    self.assertEqual(pos.mvv_lva(move), 0)
+            captures = sorted(m for m in pos.gen_moves() if pos.mvv_lva(m))
+            self.assertEqual(sorted(pos.gen_captures()), captures)
+        self.assertGreater(sunfish.mvv_lva['P', 'Q'], sunfish.mvv_lva['Q', 'R'])
+        self.assertGreater(sunfish.mvv_lva['P', 'R'], sunfish.mvv_lva['Q', 'R'])
+
+    def test_in_check(self):
+        for pos in self.positions:
+            opp = pos.nullmove()
+            attacked = any(opp.board[j] == 'k' for i, j in opp.gen_moves())
+            self.assertEqual(pos.in_check(), attacked)
+
+    def test_see(self):
+        tests = [
+            # An undefended pawn, and a defended one behind an x-ray
+            ('1k1r4/1pp4p/p7/4p3/8/P5P1/1PP4P/2K1R3 w - - 0 1', 'e1e5', 100),
+            ('1k1r3q/1ppn3p/p4b2/4p3/8/P2N2P1/1PP1R1BP/2K1Q3 w - - 0 1', 'd3e5', -180),
+            # Pieces behind the capturer recapture through it
+            ('4k3/4p3/3p4/8/8/3Q4/8/3RK3 w - - 0 1', 'd3d6', -729),
+            ('4k3/3r4/3p4/8/8/8/3R4/3QK3 w - - 0 1', 'd2d6', 100),
+        ]
+        for fen, move, score in tests:
+            pos = tools.parseFEN(fen)
+            move = tools.mparse(tools.get_color(pos), move)
+            self.assertEqual(pos.see(move), score)
+            bpos = bitboard.Position(pos.board, pos.score, pos.wc, pos.bc, pos.ep, pos.kp)
+            self.assertEqual(bpos.see(move), score)
+
+    def test_pvs(self):
+        mate_file = os.path.join(os.path.dirname(__file__), 'tests/mate1.fen')
+        for line in list(open(mate_file))[:20]:
+            pos = tools.parseFEN(line)
+            searcher = sunfish.Searcher(table_size=1, pvs=True)
+            for _ in searcher._search(pos):
+                if searcher.depth == 2: break
+            move = searcher.tp.get_move(pos.hash)
+            self.assertIn(move, list(pos.gen_moves()))
+            self.assertGreaterEqual(searcher.tp.get(pos.hash, 2, True)[0], sunfish.MATE_LOWER)
+
+    def test_ordered_moves(self):
+        searcher = sunfish.Searcher()
+        for pos in self.positions[:200]:
+            moves = list(searcher.ordered_moves(pos, 1))
+            # The table move may come twice, but otherwise every move once
+            if moves and moves.count(moves[0]) == 2:
+                moves.pop(0)
+            self.assertEqual(sorted(moves), sorted(pos.gen_moves()))
+        # The quiet moves aren't generated while the captures are searched
+        pos = tools.parseFEN('4k3/8/8/3p4/4P3/8/8/4K3 w - - 0 1')
+        pos.gen_moves = None
+        self.assertEqual(next(searcher.ordered_moves(pos, 1)), tools.mparse(tools.WHITE, 'e4d5'))
+
+    def test_killers(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        searcher = sunfish.Searcher(table_size=1)
+        for _ in searcher._search(pos):
+            if searcher.depth == 4: break
+        self.assertGreater(max(searcher.history), 0)
+        # The killers at the root are quiet moves of the root position
+        for k in searcher.killers[:2]:
+            if k: self.assertIn(divmod(k, 120), list(pos.gen_moves()))
+
+    def test_make_unmake(self):
+        same = lambda mpos, pos: (''.join(mpos.board), ''.join(mpos.other), mpos.score,
+            mpos.wc, mpos.bc, mpos.ep, mpos.kp, mpos.hash, mpos.taper, mpos.phase,
+            mpos.material) == (pos.board, pos.rotate().board, pos.score, pos.wc,
+            pos.bc, pos.ep, pos.kp, pos.hash, pos.taper, pos.phase, pos.material)
+        for pos in self.positions:
+            mpos = sunfish.MutablePosition(pos)
+            for move in list(pos.gen_moves()) + [None]:
+                mpos.make_move(move)
+                self.assertTrue(same(mpos, pos.nullmove() if move is None else pos.move(move)))
+                mpos.unmake_move()
+                self.assertTrue(same(mpos, pos))
+
+    def test_eval_state(self):
+        state = lambda p: (p.taper, p.phase, p.material)
+        fresh = lambda p: sunfish.Position(p.board, p.score, p.wc, p.bc, p.ep, p.kp)
+        start = sunfish.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0)
+        self.assertEqual(start.phase, sunfish.PHASE_MAX)
+        self.assertEqual(start.evaluate(), start.score)
+        for pos in self.positions:
+            self.assertEqual(state(pos), state(fresh(pos)),
+                    "Incremental evaluation state differs from a fresh one")
+            self.assertEqual(state(pos.rotate()), state(fresh(pos.rotate())))
+        # Tuned tables bring their own taper tables, which the moves keep
+        # using
+        piece = {k: 2*v for k, v in sunfish.init_piece.items()}
+        tuned = {k: tuple(x + i for i, x in enumerate(table))
+                 for k, table in sunfish.init_pst.items()}
+        pst = sunfish.pad_tables(tuned, piece)
+        pst_taper = sunfish.taper_tables(pst, piece)
+        fresh = lambda p: sunfish.Position(p.board, p.score, p.wc, p.bc, p.ep, p.kp,
+                                           pst, pst_taper=pst_taper)
+        for module in (sunfish, bitboard):
+            pos = module.Position(sunfish.initial, 0, (True,True), (True,True), 0, 0,
+                                  pst, pst_taper=pst_taper)
+            mpos = sunfish.MutablePosition(pos)
+            for move in ('e2e4', 'd7d5', 'e4d5', 'd8d5', 'b1c3', 'd5a2', 'a1a2'):
+                move = tools.mparse(tools.get_color(pos), move)
+                pos = pos.move(move)
+                mpos.make_move(move)
+                self.assertEqual(state(pos), state(fresh(pos)))
+                self.assertEqual(state(mpos.position()), state(fresh(pos)))
+            default = sunfish.Position(pos.board, pos.score, pos.wc, pos.bc, pos.ep, pos.kp)
+            self.assertNotEqual(pos.taper, default.taper)
+        # Lone kings, or a king and a minor piece, can't win
+        pos = tools.parseFEN('8/8/4k3/8/8/3NK3/8/8 w - - 0 1')
+        self.assertEqual(pos.evaluate(), 0)
+        pos = tools.parseFEN('8/8/4k3/8/8/3RK3/8/8 w - - 0 1')
+        self.assertGreater(pos.evaluate(), 0)
+
+    def test_pawn_hash(self):
+        fresh = lambda p: sunfish.Position(p.board, p.score, p.wc, p.bc, p.ep, p.kp)
+        pawns = sunfish.PawnTable()
+        for pos in self.positions:
+            self.assertEqual(pos.pawn_hash, fresh(pos).pawn_hash,
+                    "Incremental pawn key differs from a fresh one")
+            self.assertEqual(pos.rotate().pawn_hash, fresh(pos.rotate()).pawn_hash)
+            self.assertEqual(pos.evaluate(pawns), pos.evaluate())
+            self.assertEqual(sunfish.pawn_structure(pos.rotate().board),
+                             -sunfish.pawn_structure(pos.board))
+        self.assertGreater(pawns.hits, 0)
+        # The table is kept between the moves of a game, where pawns move
+        # rarely enough for more than 95% hits
+        pos = tools.parseFEN('rnb2knr/1p1p1ppp/3Np3/6q1/4P3/P7/P1P2PPP/R2QKB1R w KQ - 0 1')
+        searcher = sunfish.Searcher()
+        for _ in range(6):
+            for _ in searcher._search(pos):
+                if searcher.depth == 6:
+                    break
+            pos = pos.move(searcher.tp.get_move(pos.hash))
+        self.assertGreater(searcher.pawns.hits, .95 * searcher.pawns.lookups)
+        # An isolated passed pawn on the seventh, against doubled isolated
+        # passed pawns on the third and fourth
+        pos = tools.parseFEN('4k3/P7/2p5/2p5/8/8/8/4K3 w - - 0 1')
+        ours = sunfish.passed_pawn[3] + sunfish.ISOLATED_PAWN
+        theirs = 2*sunfish.DOUBLED_PAWN + 2*sunfish.ISOLATED_PAWN \
+            + sunfish.passed_pawn[7] + sunfish.passed_pawn[6]
+        self.assertEqual(sunfish.pawn_structure(pos.board), ours - theirs)
+
+    def test_hash(self):
+        for pos in self.positions:
+            fresh = lambda p: sunfish.Position(p.board, p.score, p.wc, p.bc, p.ep, p.kp)
+            self.assertEqual(pos.hash, fresh(pos).hash,
+                    "Incremental zobrist key differs from a fresh one")
+            self.assertEqual(pos.rotate().hash, fresh(pos.rotate()).hash)
+            self.assertEqual(pos.nullmove().hash, fresh(pos.nullmove()).hash)
+            self.assertEqual(pos, pos.rotate().rotate())
+            self.assertNotEqual(pos, pos.rotate())
+        # Transpositions should be recognized
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        moves = [tools.mparse(c, m) for c, m in zip([0,1,0,1], ['g1f3', 'g8f6', 'b1c3', 'b8c6'])]
+        pos1 = pos.move(moves[0]).move(moves[1]).move(moves[2]).move(moves[3])
+        pos2 = pos.move(moves[2]).move(moves[3]).move(moves[0]).move(moves[1])
+        self.assertEqual(pos1, pos2)
+
+    def test_table(self):
+        tp = sunfish.TranspositionTable(mb=1)
+        key = self.positions[1].hash
+        self.assertEqual(tp.get(key, 3, False), (-sunfish.MATE_UPPER, sunfish.MATE_UPPER))
+        tp.put(key, 3, False, 10, 20, (84, 64))
+        tp.put(key, 1, False, -5, 5)
+        self.assertEqual(tp.get(key, 3, False), (10, 20))
+        self.assertEqual(tp.get(key, 1, False), (-5, 5))
+        self.assertEqual(tp.get(key, 3, True), (-sunfish.MATE_UPPER, sunfish.MATE_UPPER))
+        self.assertEqual(tp.get_move(key), (84, 64))
+        tp.put(key, 3, False, 10, 10, None)
+        self.assertEqual(tp.get_move(key), None)
+        # The depth preferred slot is kept for a shallower colliding key
+        other = key - tp.buckets
+        tp.put(other, 0, False, 1, 2, (85, 65))
+        self.assertEqual(tp.get(key, 3, False), (10, 10))
+        self.assertEqual(tp.get_move(other), (85, 65))
+
+    def test_parallel(self):
+        searcher = parallel.ParallelSearcher(threads=2, table_size=1)
+        try:
+            pos = self.positions[0]
+            move, _ = searcher.search(pos, .5)
+            self.assertIn(move, pos.gen_moves())
+            self.assertGreater(sum(searcher.helper_nodes), 0)
+            # The helpers are given the settings of the main search
+            searcher.pvs = True
+            move, _ = searcher.search(pos, .5)
+            self.assertIn(move, pos.gen_moves())
+            self.assertGreater(sum(searcher.helper_nodes), 0)
+        finally:
+            searcher.close()
+
+    def test_stop(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        searcher = sunfish.Searcher()
+        # Stopped in the middle of depth 5, the result of depth 4 is kept
+        for _ in searcher._search(pos):
+            if searcher.depth == 4:
+                move = searcher.tp.get_move(pos.hash)
+                searcher.should_stop = lambda: True
+        self.assertEqual(searcher.depth, 4)
+        self.assertEqual(searcher.tp.get_move(pos.hash), move)
+        # A thinker doesn't wait for the end of a depth to stop
+        thinker = tools.Thinker(sunfish.Searcher(), pos, timeman.TimeManager(movetime=.2))
+        start = time.time()
+        thinker.run()
+        self.assertLess(time.time() - start, .3)
+        self.assertIn(thinker.best()[0], list(pos.gen_moves()))
+
+    def test_timeman(self):
+        clock = timeman.TimeManager(60, 1)
+        self.assertAlmostEqual(clock.soft, (60 - timeman.OVERHEAD)/timeman.MOVES_TO_GO + 1)
+        self.assertAlmostEqual(clock.hard, timeman.HARD_RATIO * clock.soft)
+        # Never more than part of the clock, even with one move to go
+        clock = timeman.TimeManager(10, 0, 1)
+        self.assertLessEqual(clock.hard, timeman.MAX_USE * 10)
+        self.assertLessEqual(clock.soft, clock.hard)
+        self.assertRaises(ValueError, timeman.TimeManager)
+        # A stable best move gets less time than a changing one
+        stable, changing = timeman.TimeManager(30), timeman.TimeManager(30)
+        for k in range(10):
+            stable.next_depth((1, 2))
+            changing.next_depth((1, k))
+        stable.start = changing.start = time.time() - stable.soft
+        self.assertFalse(stable.next_depth((1, 2)))
+        self.assertTrue(changing.next_depth((1, 11)))
+        # With little time left the search is cut short in a depth
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        thinker = tools.Thinker(sunfish.Searcher(), pos, timeman.TimeManager(1))
+        start = time.time()
+        thinker.run()
+        self.assertLess(time.time() - start, timeman.MAX_USE + .1)
+        self.assertIn(thinker.best()[0], list(pos.gen_moves()))
+
+    def test_ponder(self):
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        searcher = sunfish.Searcher()
+        finished = []
+        thinker = tools.Thinker(searcher, pos, depth=2, ponder=True, finish=finished.append)
+        thinker.start()
+        # Pondering goes on past the limits, until ponderhit
+        time.sleep(.5)
+        self.assertTrue(thinker.is_alive())
+        self.assertGreater(searcher.depth, 2)
+        thinker.ponderhit()
+        thinker.join(10)
+        self.assertFalse(thinker.is_alive())
+        self.assertEqual(finished, [thinker])
+        self.assertIn(thinker.best()[0], list(pos.gen_moves()))
+        thinker = tools.Thinker(searcher, pos.move(thinker.best()[0]), ponder=True)
+        thinker.start()
+        time.sleep(.1)
+        thinker.stop()
+        thinker.join(10)
+        self.assertFalse(thinker.is_alive())
+
+    def test_archive(self):
+        folder = tempfile.mkdtemp()
+        archive = Genetic.Archive(os.path.join(folder, 'games'))
+        self.assertEqual(list(archive.games()), [])
+        games = [(['e2e4', 'e7e5', 'g1f3'], 'White', 1, 2), ([], 'Draw - Repetition', 3, 4),
+                 (['a7a8', 'h2h1'], 'Black', 2**32-1, 0)]
+        for k, game in enumerate(games):
+            self.assertEqual(archive.append(*game), k+1)
+        self.assertEqual(len(archive), 3)
+        self.assertEqual(archive.load(3), games[2])
+        self.assertEqual(archive.load(1), games[0])
+        self.assertEqual(list(archive.games()), games)
+        # The folder of an archive is made by the first game
+        archive = Genetic.Archive(os.path.join(folder, 'new', 'games'))
+        self.assertEqual(archive.append(*games[0]), 1)
+        shutil.rmtree(folder)
+
+    def test_book(self):
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, 'book.bin')
+        pgn_file = os.path.join(os.path.dirname(__file__), 'tests/pgns.pgn')
+        games = list(tools.readPGN(open(pgn_file)))
+        n = book.build(games, path, plies=8)
+        opening_book = book.Book(path)
+        self.assertEqual(len(opening_book), n)
+        pos = tools.parseFEN(tools.FEN_INITIAL)
+        firsts = {tools.mrender(pos, moves[0]) for _, moves in games if moves}
+        self.assertEqual({tools.mrender(pos, m) for m, _ in opening_book.get(pos)}, firsts)
+        self.assertIn(tools.mrender(pos, opening_book.choose(pos)), firsts)
+        # Every position of the games is found, whatever the colour
+        for _, moves in games[:20]:
+            pos = tools.parseFEN(tools.FEN_INITIAL)
+            for move in moves[:8]:
+                self.assertIn(move, [m for m, _ in opening_book.get(pos)])
+                pos = pos.move(move)
+            self.assertEqual(opening_book.choose(pos), None)
+        # Moves are encoded as in Polyglot, castling as the king taking the rook
+        pos = tools.parseFEN('r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 1')
+        self.assertEqual(book.encode_move(pos, tools.mparse(tools.BLACK, 'e8g8')), 60 << 6 | 63)
+        for move in pos.gen_moves():
+            self.assertEqual(book.decode_move(pos, book.encode_move(pos, move)), move)
+        # The keys are Polyglot's, as in the examples of its specification
+        keys = {'': 0x463b96181691fc9c, 'e2e4 d7d5 e4e5 f7f5': 0x22a48b5a8e47ff78,
+                'e2e4 d7d5 e4e5 f7f5 e1e2 e8f7': 0x00fdd303c946bdd9,
+                'a2a4 b7b5 h2h4 b5b4 c2c4 b4c3 a1a3': 0x5c3f9b829b279560}
+        for moves, key in keys.items():
+            pos = tools.parseFEN(tools.FEN_INITIAL)
+            for k, move in enumerate(moves.split()):
+                pos = pos.move(tools.mparse(k % 2, move))
+            self.assertEqual(book.key(pos), key)
+        opening_book.close()
+        shutil.rmtree(folder)
+
+    def test_sprt(self):
+        sprt = tools.SPRT(0, 10)
+        self.assertEqual(sprt.status(), 0)
+        # Even results accept elo0, and a clearly stronger engine elo1
+        for result in itertools.islice(itertools.cycle((1, 0, -1, 0)), 20000):
+            sprt.add(result)
+            if sprt.status(): break
+        self.assertEqual(sprt.status(), -1)
+        sprt = tools.SPRT(0, 10)
+        for result in itertools.islice(itertools.cycle((1, 1, 0, -1)), 20000):
+            sprt.add(result)
+            if sprt.status(): break
+        self.assertEqual(sprt.status(), 1)
+        self.assertLess(sprt.wins + sprt.draws + sprt.losses, 1000)
+
+    @unittest.skipIf(tablebase.np is None, 'generating tablebases needs numpy')
+    def test_tablebase(self):
+        folder = tempfile.mkdtemp()
+        tablebase.generate('KRvK', folder, verbose=False)
+        tablebase.generate('KQvK', folder, verbose=False)
+        self.assertEqual(sorted(os.listdir(folder)), ['KQvK.dtm', 'KRvK.dtm', 'KvK.dtm', 'KvKQ.dtm', 'KvKR.dtm'])
+        tablebases = tablebase.Tablebases(folder)
+        for fen, plies in (('8/8/8/8/8/8/8/K6k b - - 0 1', 0),
+                           ('7k/5K2/6R1/8/8/8/8/8 w - - 0 1', 1),
+                           ('6k1/8/6K1/8/8/8/8/R7 w - - 0 1', 1)):
+            score = tablebases.probe(tools.parseFEN(fen))
+            self.assertEqual(score, sunfish.MATE_UPPER - plies if plies else 0, fen)
+        # The longest mates are in 10 and 16 moves
+        longest = {}
+        for name in ('KQvK', 'KRvK'):
+            values = open(os.path.join(folder, name + tablebase.EXT), 'rb').read()
+            longest[name] = max(v for v in values if v < 128) - 1
+        self.assertEqual(longest, {'KQvK': 19, 'KRvK': 31})
+        # Every score follows from those of the moves
+        rng = random.Random(0)
+        for _ in range(200):
+            board = ['.'] * 64
+            for k, p in zip(rng.sample(range(64), 3), rng.choice(('KRk', 'KQk', 'kqK'))):
+                board[k] = p
+            fen = '/'.join(''.join(board[k:k+8]) for k in range(0, 64, 8))
+            fen = re.sub(r'\.+', lambda m: str(len(m.group(0))), fen) + ' ' + rng.choice('wb') + ' - - 0 1'
+            pos = tools.parseFEN(fen)
+            score = tablebases.probe(pos)
+            if score == sunfish.MATE_UPPER: continue
+            best = max(-tablebases.probe(pos.move(m)) for m in pos.gen_moves())
+            if best == -sunfish.MATE_UPPER:
+                best = -sunfish.MATE_UPPER if pos.in_check() else 0
+            elif best:
+                best -= 1 if best > 0 else -1
+            self.assertEqual(score, best, fen)
+        # The searcher plays the shortest mate, without searching
+        pos = tools.parseFEN('8/8/8/4k3/8/8/8/R3K3 w - - 0 1')
+        searcher = sunfish.Searcher()
+        searcher.tablebase = tablebases
+        move, score = searcher.search(pos, secs=1)
+        self.assertEqual(score, tablebases.best_move(pos)[1])
+        for _ in range(sunfish.MATE_UPPER - score):
+            pos = pos.move(searcher.search(pos, secs=1)[0])
+        self.assertEqual(tablebases.probe(pos), -sunfish.MATE_UPPER)
+        self.assertEqual(searcher.nodes, 0)
+        # So do the helpers of a parallel search, which open the same tables
+        searcher = parallel.ParallelSearcher(threads=2, table_size=1)
+        try:
+            searcher.tablebase = tablebases
+            searcher.search(tools.parseFEN('8/8/8/4k3/8/8/8/R3K3 w - - 0 1'), secs=1)
+            time.sleep(1)
+            self.assertEqual(list(searcher.helper_nodes), [0])
+        finally:
+            searcher.close()
+        tablebases.close()
+        shutil.rmtree(folder)
+
+    @unittest.skipIf(batch is None, 'batch needs numpy')
+    def test_batch(self):
+        fen_file = os.path.join(os.path.dirname(__file__), 'tests/chessathome_openings.fen')
+        fens = [fen.strip() for fen in open(fen_file)]
+        scores = batch.pst_scores(batch.encode_fens(fens))
+        self.assertEqual(list(scores), [tools.parseFEN(fen).score for fen in fens])
+        codes = batch.encode_boards(pos.board for pos in self.positions)
+        self.assertEqual(list(batch.pst_scores(codes)), [pos.score for pos in self.positions])
+
+    @unittest.skipIf(texel is None, 'texel needs numpy')
+    def test_texel(self):
+        self.assertEqual(texel.parse_result('8/8/8/8/8/8/8/K1k5 w - - c9 "1/2-1/2";'), .5)
+        self.assertEqual(texel.parse_result('8/8/8/8/8/8/8/K1k5 w - - 0 1 [1.0]'), 1.)
+        fen_file = os.path.join(os.path.dirname(__file__), 'tests/chessathome_openings.fen')
+        codes = batch.encode_fens(open(fen_file))
+        table = batch.pst_table()
+        self.assertEqual(list(texel.scores(codes, table)), list(batch.pst_scores(codes)))
+        # The score is Position.evaluate's, without its rounding and draw rule
+        arrays = lambda pst, piece: (batch.np.array([pst[p] for p in texel.PIECES]),
+                                     batch.np.array([piece[p] for p in texel.PIECES]))
+        init = arrays(sunfish.init_pst, sunfish.init_piece)
+        bcodes = batch.encode_boards(pos.board for pos in self.positions)
+        expected = [pos.score + sunfish.pawn_structure(pos.board)
+                    + pos.taper * max(sunfish.PHASE_MAX-pos.phase, 0) / sunfish.PHASE_MAX
+                    for pos in self.positions]
+        scores = texel.evaluate(bcodes, texel.features(bcodes), *init)
+        self.assertTrue(batch.np.allclose(scores, expected))
+        # Results that the tables of sunfish fit perfectly, to tune worse
+        # tables back towards
+        feats = texel.features(codes)
+        results = 1 / (1 + batch.np.exp(-.004*texel.evaluate(codes, feats, *init)))
+        pst = {p: tuple(x + (i % 3 - 1) * 30 for i, x in enumerate(t))
+               for p, t in sunfish.init_pst.items()}
+        before = texel.loss(codes, results, feats, *arrays(pst, sunfish.init_piece), .004)
+        pst, piece = texel.tune(codes, results, pst, epochs=5, batch_size=1024, verbose=False)
+        self.assertEqual(piece['K'], sunfish.init_piece['K'])
+        self.assertLess(texel.loss(codes, results, feats, *arrays(pst, piece), .004), before)
+
     def test_xboard(self):
         test_xboard('pypy3', verbose=False)
         test_xboard('python3', verbose=False)
@@ -133,28 +624,57 @@ def unstable():
 # Benchmarking
 ###############################################################################
 
-def benchmark(cnt=20, depth=3):
+def benchmark(cnt=20, depth=3, make_unmake=False):
     path = os.path.join(os.path.dirname(__file__), 'tests/chessathome_openings.fen')
     random.seed(0)
-    start = time.time()
-    nodes = 0
-    for i, line in enumerate(random.sample(list(open(path)), cnt)):
-        pos = tools.parseFEN(line)
-        searcher = sunfish.Searcher()
-        start1 = time.time()
-        for _ in searcher._search(pos):
-            speed = int(round(searcher.nodes/(time.time()-start1)))
-            print('Benchmark: {}/{}, Depth: {}, Speed: {:,}N/s'.format(
-                i+1, cnt, searcher.depth, speed), end='\r')
-            sys.stdout.flush()
-            if searcher.depth == depth:
-                nodes += searcher.nodes
-                break
-    print()
-    total_time = time.time() - start
-    speed = int(round(nodes/total_time))
-    print('Total time: {}, Total nodes: {}, Average speed: {:,}N/s'.format(
-        total_time, nodes, speed))
+    lines = random.sample(list(open(path)), cnt)
+    for name, pvs in (('MTD-bi', False), ('PVS', True)):
+        start = time.time()
+        nodes = 0
+        # Time to reach each depth, summed over the positions
+        depth_times = [0]*depth
+        for i, line in enumerate(lines):
+            pos = tools.parseFEN(line)
+            searcher = sunfish.Searcher(make_unmake=make_unmake, pvs=pvs)
+            start1 = time.time()
+            for _ in searcher._search(pos):
+                depth_times[searcher.depth-1] += time.time() - start1
+                speed = int(round(searcher.nodes/(time.time()-start1)))
+                print('Benchmark {}: {}/{}, Depth: {}, Speed: {:,}N/s'.format(
+                    name, i+1, cnt, searcher.depth, speed), end='\r')
+                sys.stdout.flush()
+                if searcher.depth == depth:
+                    nodes += searcher.nodes
+                    break
+        print()
+        total_time = time.time() - start
+        speed = int(round(nodes/total_time))
+        print('Total time: {}, Total nodes: {}, Average speed: {:,}N/s'.format(
+            total_time, nodes, speed))
+        print('Time to depth: {}'.format(', '.join(
+            '{}: {:.2f}s'.format(d+1, t) for d, t in enumerate(depth_times))))
+
+
+def benchmark_see():
+    ''' Time the static exchange evaluation of every capture in the positions
+    of tests/, on each of the move generators. '''
+    folder = os.path.join(os.path.dirname(__file__), 'tests')
+    positions = []
+    for name in sorted(os.listdir(folder)):
+        if name.endswith(('.fen', '.epd')):
+            for line in open(os.path.join(folder, name)):
+                if line.strip():
+                    positions.append(tools.parseFEN(tools.parseEPD(line)[0]))
+    for module in (sunfish, bitboard):
+        poss = [module.Position(pos.board, pos.score, pos.wc, pos.bc, pos.ep, pos.kp)
+                for pos in positions]
+        captures = [(pos, move) for pos in poss for move in pos.gen_captures()]
+        start = time.time()
+        losing = sum(pos.see(move) < 0 for pos, move in captures)
+        total_time = time.time() - start
+        print('{}: {} positions, {} captures, {} losing, {:,} SEE/s'.format(
+            module.__name__, len(poss), len(captures), losing,
+            int(round(len(captures)/total_time))))
 
 
 ###############################################################################
@@ -175,7 +695,9 @@ def selfplay(secs=1):
         print("\nmove", tools.mrender(pos, m))
         pos = pos.move(m)
 
-def self_arena(version1, version2, games, secs, plus):
+def self_arena(version1, version2, games, secs, plus, sprt=None):
+    ''' Plays games between two versions. If sprt is a tools.SPRT, the games
+    stop as soon as it is decided. '''
     print('Playing {} games of {} vs. {} at {} secs/game + {} secs/move'
             .format(games, version1, version2, secs, plus))
     openings_file = os.path.join(os.path.dirname(__file__), 'tests/chessathome_openings.fen')
@@ -196,12 +718,21 @@ def self_arena(version1, version2, games, secs, plus):
         if r == version2:
             losses += 1
             print('l', end='', flush=True)
+        if sprt is not None:
+            sprt.add(1 if r == version1 else -1 if r == version2 else 0)
+            print(' ' + str(sprt))
+            if sprt.status():
+                pool.terminate()
+                games = i+1
+                break
         if i % 80 == 79:
             print()
             print('{} wins, {} draws, {} losses out of {}'.format(wins,i+1-wins-losses,losses,i+1))
     print()
 
     print('Result: {} wins, {} draws, {} losses out of {}'.format(wins,games-wins-losses,losses,games))
+    if sprt is not None:
+        print('SPRT: {}'.format(('H0 accepted', 'undecided', 'H1 accepted')[sprt.status()+1]))
 
 
 def play(version1_version2_secs_plus_fen):
@@ -214,18 +745,18 @@ def play(version1_version2_secs_plus_fen):
             searchers.append(module.Searcher())
         else: searchers.append(module)
     times = [secs, secs]
-    efactor = [1, 1]
     pos = tools.parseFEN(fen)
     seen = set()
     for d in range(200):
-        moves_remain = 30
-        use = times[d%2]/moves_remain + plus
-        # Use a bit more time, if we have more on the clock than our opponent
-        use += (times[d%2] - times[(d+1)%2])/10
-        use = max(use, plus)
+        clock = timeman.TimeManager(times[d%2], plus)
         t = time.time()
-        m, score = searchers[d%2].search(pos, use*efactor[d%2])
-        efactor[d%2] *= (use/(time.time() - t))**.5
+        # Versions that can't be stopped in a depth are just given the time
+        if hasattr(searchers[d%2], 'should_stop'):
+            thinker = tools.Thinker(searchers[d%2], pos, clock)
+            thinker.run()
+            m, score = thinker.best()
+        else:
+            m, score = searchers[d%2].search(pos, clock.soft)
         times[d%2] -= time.time() - t
         times[d%2] += plus
         #print('Used {:.2} rather than {:.2}. Off by {:.2}. Remaining: {}'
@@ -321,6 +852,7 @@ def test_xboard(python='python3', verbose=True):
         write('xboard')
         write('protover 2')
         wait_for(r'done\s*=\s*1')
+        write('hard')
         write('usermove e2e4')
         wait_for('move ')
         write('setboard rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR b KQkq - 0 1')
@@ -337,7 +869,7 @@ def test_xboard(python='python3', verbose=True):
 # Perft test
 ###############################################################################
 
-def allperft(f, depth=4, verbose=True):
+def allperft(f, depth=4, verbose=True, position=sunfish.Position):
     import gc
     lines = f.readlines()
     for d in range(1, depth+1):
@@ -348,7 +880,7 @@ def allperft(f, depth=4, verbose=True):
             if verbose:
                 print(parts[0])
 
-            pos, score = tools.parseFEN(parts[0]), int(parts[d])
+            pos, score = tools.parseFEN(parts[0], position), int(parts[d])
             res = sum(1 for _ in tools.collect_tree_depth(tools.expand_position(pos), d))
             if res != score:
                 print('=========================================')
@@ -483,7 +1015,10 @@ def main():
     p.add_argument('--depth', type=int, default=2)
     p.add_argument('file', type=argparse.FileType('r'),
         help='such as tests/queen.fen.')
-    add_action(p, lambda n: allperft(n.file, n.depth))
+    p.add_argument('--module', type=str, default='sunfish',
+        help='module providing the Position to test, e.g. bitboard. Default=%(default)s.')
+    add_action(p, lambda n: allperft(n.file, n.depth,
+        position=importlib.import_module(n.module).Position))
 
     p = subparsers.add_parser('quickmate',
         help='uses the `bound` function directly to search for moves that will win us the game.')
@@ -523,7 +1058,15 @@ def main():
         help='number of seconds to search per game. Default=%(default)s.')
     p.add_argument('--plus', type=float, default=.1,
         help='seconds time increment per move. Default=%(default)s.')
-    add_action(p, lambda n: self_arena(n.fish1, n.fish2, n.games, n.seconds, n.plus))
+    p.add_argument('--sprt', type=float, nargs=2, metavar=('ELO0', 'ELO1'),
+        help='stop once a sequential probability ratio test decides if fish1 is ELO0 '
+             'or ELO1 stronger. --games is then the maximum number of games.')
+    p.add_argument('--alpha', type=float, default=.05,
+        help='SPRT false positive rate. Default=%(default)s.')
+    p.add_argument('--beta', type=float, default=.05,
+        help='SPRT false negative rate. Default=%(default)s.')
+    add_action(p, lambda n: self_arena(n.fish1, n.fish2, n.games, n.seconds, n.plus,
+        tools.SPRT(n.sprt[0], n.sprt[1], n.alpha, n.beta) if n.sprt else None))
 
     p = subparsers.add_parser('findbest',
         help='reports the best moves found at certain positions after certain intervals of time.')
@@ -539,8 +1082,16 @@ def main():
     add_action(p, lambda n: unstable())
 
     p = subparsers.add_parser('benchmark',
-        help='Search a few positions to a fixed depth (IID), and measure the time it took.')
-    add_action(p, lambda n: benchmark())
+        help='Search a few positions to a fixed depth (IID) with both the MTD-bi and the PVS driver, and measure the time it took.')
+    p.add_argument('--make-unmake', action='store_true',
+        help='search on a single mutable board with make/unmake.')
+    p.add_argument('--depth', type=int, default=3,
+        help='the depth to search each position to.')
+    add_action(p, lambda n: benchmark(depth=n.depth, make_unmake=n.make_unmake))
+
+    p = subparsers.add_parser('see',
+        help='Measure the speed of static exchange evaluation on the positions in tests/.')
+    add_action(p, lambda n: benchmark_see())
 
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(Tests)
     p = subparsers.add_parser('unittest',
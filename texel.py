@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+import re
+import time
+import argparse
+
+import numpy as np
+
+import sunfish
+import batch
+from Genetic import PST
+
+###############################################################################
+# Texel tuning. Rather than playing games, the piece-square tables and piece
+# values are fitted to the results of the games a set of positions came from.
+# The score s of a position is turned into an expected result by the sigmoid
+# 1/(1+exp(-k*s)), and the tables are changed by gradient steps on the
+# logistic loss against the actual results.
+#
+# The score is that of Position.evaluate, with the tables taken as tuned ones
+# (see sunfish.taper_tables): the middle game tables of the pieces with
+# endgame tables are tapered to those by the phase, and the pawn structure is
+# added. Only the middle game tables and piece values are fitted, the endgame
+# tables and the pawn structure are fixed features of each position.
+# The score is linear in the tables, it is a sum over the squares of
+# batch.pst_table, so the gradient of the (13, 64) table is a bincount over
+# the encoded boards, which then maps back onto init_pst and init_piece.
+###############################################################################
+
+PIECES = 'PNBRQK'
+
+# The pieces whose middle game tables are tapered away in the endgame
+TAPERED = np.array([[c in sunfish.init_pst_eg] for c in PIECES])
+
+# The phase weight of each code of batch.encode_fens
+_phase = np.array([0] + [sunfish.phase_weight[p] for p in batch.PIECES])
+
+# Results of the labelled positions, for white
+_results = {'1-0': 1., '0-1': 0., '1/2-1/2': .5}
+
+
+def parse_result(line):
+    ''' The result of a labelled position, either as a PGN result, like
+    "1-0", or as a number in brackets, like [0.5]. '''
+    m = re.search(r'(1-0|0-1|1/2-1/2)', line)
+    if m:
+        return _results[m.group(1)]
+    m = re.search(r'\[([\d.]+)\]', line)
+    if m:
+        return float(m.group(1))
+    raise ValueError('No result in: ' + line)
+
+
+def load_positions(path):
+    ''' The encoded boards of a file of FEN or EPD lines, each with the result
+    of its game, and the results from the side to move. '''
+    lines = [line for line in open(path) if line.strip()]
+    codes = batch.encode_fens(lines)
+    results = np.array([parse_result(line) for line in lines])
+    black = np.array([line.split()[1] == 'b' for line in lines])
+    results[black] = 1 - results[black]
+    return codes, results
+
+
+def to_table(pst, piece):
+    ''' The (13, 64) table of batch.pst_table, from arrays of the unpadded
+    tables and piece values, in the order of PIECES. '''
+    ours = pst + piece[:, None]
+    table = np.zeros((13, 64))
+    table[1:7] = ours
+    table[7:13] = -ours[:, ::-1]
+    return table
+
+
+def scores(codes, table):
+    ''' The scores of the encoded boards by a (13, 64) table '''
+    return table.ravel()[codes.astype(np.intp)*64 + np.arange(64)].sum(axis=1)
+
+
+def pawn_scores(codes):
+    ''' The sunfish.pawn_structure of the encoded boards. The positions of a
+    game mostly share their pawns, so each structure is only scored once. '''
+    pawns = np.where((codes == 1) | (codes == 7), codes, 0)
+    cache = {}
+    result = np.empty(len(codes))
+    for n, row in enumerate(pawns):
+        key = row.tobytes()
+        if key not in cache:
+            board = [' ']*120
+            for i, c in zip(sunfish.sq120, row):
+                if c: board[i] = 'P' if c == 1 else 'p'
+            cache[key] = sunfish.pawn_structure(board)
+        result[n] = cache[key]
+    return result
+
+
+def features(codes):
+    ''' The fixed features of the encoded boards: the weight of the endgame
+    tables, from 0 at PHASE_MAX to 1 without pieces, and the part of the score
+    that isn't fitted, the weighted endgame tables and the pawn structure. '''
+    phase = _phase[codes.astype(np.intp)].sum(axis=1)
+    w = np.maximum(sunfish.PHASE_MAX - phase, 0) / sunfish.PHASE_MAX
+    eg = np.array([sunfish.init_pst_eg.get(c, (0,)*64) for c in PIECES], dtype=float)
+    fixed = w * scores(codes, to_table(eg, np.zeros(len(PIECES)))) + pawn_scores(codes)
+    return w, fixed
+
+
+def evaluate(codes, feats, pst, piece):
+    ''' The scores of the encoded boards by arrays of the unpadded tables and
+    piece values, like Position.evaluate but without rounding. feats are the
+    features of the boards. '''
+    w, fixed = feats
+    tapered = to_table(pst * TAPERED, np.zeros(len(PIECES)))
+    return scores(codes, to_table(pst, piece)) - w * scores(codes, tapered) + fixed
+
+
+def loss(codes, results, feats, pst, piece, k):
+    ''' The mean logistic loss of the positions '''
+    x = k * evaluate(codes, feats, pst, piece)
+    # -r*log(sigmoid(x)) - (1-r)*log(1-sigmoid(x)), computed without overflow
+    return np.mean(np.logaddexp(0, -x) + (1-results)*x)
+
+
+def fit_scale(codes, results, feats, pst, piece, sample=1 << 16):
+    ''' The k of the sigmoid that fits the current tables best. A single
+    number is well fitted by a sample of the positions. '''
+    sample = np.random.default_rng(0).permutation(len(codes))[:sample]
+    codes, results = codes[sample], results[sample]
+    feats = tuple(f[sample] for f in feats)
+    ks = np.logspace(-4, -1, 61)
+    return min(ks, key=lambda k: loss(codes, results, feats, pst, piece, k))
+
+
+def gradient(codes, results, feats, pst, piece, k):
+    ''' The gradient of the loss by the unpadded tables and piece values '''
+    w, _ = feats
+    x = k * evaluate(codes, feats, pst, piece)
+    g = k * (1/(1+np.exp(-x)) - results) / len(codes)
+    idx = (codes.astype(np.intp)*64 + np.arange(64)).ravel()
+    gt = np.bincount(idx, weights=np.repeat(g, 64), minlength=13*64).reshape(13, 64)
+    gw = np.bincount(idx, weights=np.repeat(g*w, 64), minlength=13*64).reshape(13, 64)
+    gfull = gt[1:7] - gt[7:13, ::-1]
+    gpst = gfull - TAPERED * (gw[1:7] - gw[7:13, ::-1])
+    gpiece = gfull.sum(axis=1)
+    return gpst, gpiece
+
+
+def tune(codes, results, pst=sunfish.init_pst, piece=sunfish.init_piece,
+         epochs=50, batch_size=1 << 14, rate=1., verbose=True):
+    ''' Fits the tables to the results by Adam on minibatches. Returns the
+    new init_pst and init_piece dictionaries, rounded to integers. The king's
+    value is kept, since the search relies on it to find mates. '''
+    p = np.array([pst[c] for c in PIECES], dtype=float)
+    v = np.array([piece[c] for c in PIECES], dtype=float)
+    feats = features(codes)
+    k = fit_scale(codes, results, feats, p, v)
+    if verbose:
+        print('k = {:.5f}, loss = {:.5f}'.format(k, loss(codes, results, feats, p, v, k)))
+    beta1, beta2, eps = .9, .999, 1e-8
+    m = [np.zeros_like(p), np.zeros_like(v)]
+    s = [np.zeros_like(p), np.zeros_like(v)]
+    rng = np.random.default_rng(0)
+    step = 0
+    for epoch in range(epochs):
+        start = time.time()
+        order = rng.permutation(len(codes))
+        for a in range(0, len(codes), batch_size):
+            sample = order[a:a+batch_size]
+            grads = gradient(codes[sample], results[sample],
+                             tuple(f[sample] for f in feats), p, v, k)
+            grads[1][PIECES.index('K')] = 0
+            step += 1
+            for x, g, mx, sx in zip((p, v), grads, m, s):
+                mx *= beta1
+                mx += (1-beta1) * g
+                sx *= beta2
+                sx += (1-beta2) * g*g
+                mhat = mx / (1-beta1**step)
+                shat = sx / (1-beta2**step)
+                x -= rate * mhat / (np.sqrt(shat) + eps)
+        if verbose:
+            print('epoch {}: loss = {:.5f} ({:.1f}s)'.format(
+                epoch+1, loss(codes, results, feats, p, v, k), time.time()-start))
+    new_pst = {c: tuple(int(round(x)) for x in p[i]) for i, c in enumerate(PIECES)}
+    new_piece = {c: int(round(v[i])) for i, c in enumerate(PIECES)}
+    return new_pst, new_piece
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fit the piece-square tables to the results of labelled positions, '
+                    'and store them like Genetic.PST.save_data.')
+    parser.add_argument('positions', help='file of FEN or EPD lines, each with the result '
+                        'of its game, e.g. 1-0 or [1.0]')
+    parser.add_argument('--init', default=None, help='prefix of the stored tables to start '
+                        'from, the tables of sunfish if not given')
+    parser.add_argument('--prefix', default='Texel', help='prefix of the tuned tables')
+    parser.add_argument('--epochs', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=1 << 14)
+    parser.add_argument('--rate', type=float, default=1.)
+    args = parser.parse_args()
+
+    pst, piece = sunfish.init_pst, sunfish.init_piece
+    if args.init is not None:
+        pst, piece = PST.load_data(args.init)
+    codes, results = load_positions(args.positions)
+    print('Loaded {} positions'.format(len(codes)))
+    pst, piece = tune(codes, results, pst, piece, args.epochs, args.batch_size, args.rate)
+    PST.save_data(pst, piece, args.prefix)
+
+
+if __name__ == '__main__':
+    main()
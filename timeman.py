@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+import time
+
+###############################################################################
+# Time management. The clock gives the search of a move two limits. After the
+# soft limit no new depth is started. At the hard limit the search stops in
+# the middle of a depth (see Searcher.should_stop) and plays the move of the
+# last full depth. A depth often takes several times as long as all the ones
+# before it, so only checking between depths would overrun badly.
+# The soft limit is scaled by how stable the best move is. A move that keeps
+# changing gets more time, and one that stays the same for a few depths gets
+# less.
+###############################################################################
+
+# The moves left to the next time control, when it isn't known
+MOVES_TO_GO = 30
+# Seconds kept on the clock for the delays of the protocol and of stopping
+OVERHEAD = .05
+# The hard limit is HARD_RATIO times the soft one, but never more than MAX_USE
+# of the clock
+HARD_RATIO = 4
+MAX_USE = .5
+# The soft limit is scaled by this, by the number of depths in a row that
+# the best move stayed the same
+STABILITY = (1.5, 1.2, 1, .8, .6)
+
+
+class TimeManager:
+    """ The limits of the search of one move, with time_left seconds on the
+    clock, inc seconds added after each move and movestogo moves to the next
+    time control. Given movetime, the search takes exactly that many seconds
+    instead. The clock starts when the TimeManager is made, or at restart. """
+
+    def __init__(self, time_left=None, inc=0, movestogo=None, movetime=None):
+        if time_left is None and movetime is None:
+            raise ValueError('Either time_left or movetime is needed')
+        self.fixed = movetime is not None
+        if self.fixed:
+            self.soft = self.hard = movetime
+        else:
+            moves = min(movestogo or MOVES_TO_GO, MOVES_TO_GO)
+            left = max(time_left - OVERHEAD, 0)
+            self.hard = min(HARD_RATIO * (left/moves + inc), MAX_USE * left)
+            self.soft = min(left/moves + inc, self.hard)
+        # The best move of the last depth, and the depths it has been best
+        self.move, self.same = None, 0
+        self.restart()
+
+    def restart(self):
+        """ Starts the clock, e.g. at a ponder hit """
+        self.start = time.time()
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def out_of_time(self):
+        """ Whether the hard limit is reached. It is cheap, so the search
+        checks it every few nodes. """
+        return self.elapsed() > self.hard
+
+    def next_depth(self, move):
+        """ Called after each depth with its best move. Returns whether to
+        start another depth. """
+        self.same = self.same + 1 if move == self.move else 0
+        self.move = move
+        soft = self.soft
+        if not self.fixed:
+            soft *= STABILITY[min(self.same, len(STABILITY)-1)]
+        return self.elapsed() < min(soft, self.hard)
@@ -1,5 +1,10 @@
 import itertools
+import math
+import queue
 import re
+import sys
+import threading
+import time
 
 import sunfish
 
@@ -38,6 +43,23 @@ def mparse(color, move):
     m = (sunfish.parse(move[0:2]), sunfish.parse(move[2:4]))
     return m if color == WHITE else (119-m[0], 119-m[1])
 
+def _sources(pos, p, j):
+    ''' The squares of our pieces p that move to j, pins aside. Pieces move
+    the same way backwards, so we look from j along the piece's directions. '''
+    board = pos.board
+    if p in 'NK':
+        return [j-d for d in sunfish.directions[p] if board[j-d] == p]
+    srcs = []
+    for d in sunfish.directions[p]:
+        k = j-d
+        while board[k] == '.': k -= d
+        if board[k] == p: srcs.append(k)
+    return srcs
+
+def _legal(pos, move):
+    ''' Whether move doesn't leave our king attacked '''
+    return not pos.move(move).nullmove().in_check()
+
 def renderSAN(pos, move):
     ''' Assumes board is rotated to position of current player '''
     i, j = move
@@ -47,11 +69,10 @@ def renderSAN(pos, move):
         csrc, cdst = sunfish.render(119-i), sunfish.render(119-j)
     # Check
     pos1 = pos.move(move)
-    cankill = lambda p: any(p.board[b]=='k' for a,b in p.gen_moves())
     check = ''
-    if cankill(pos1.rotate()):
+    if pos1.in_check():
         check = '+'
-        if all(cankill(pos1.move(move1)) for move1 in pos1.gen_moves()):
+        if not any(True for _ in gen_legal_moves(pos1)):
             check = '#'
     # Castling
     if pos.board[i] == 'K' and abs(i-j) == 2:
@@ -65,7 +86,7 @@ def renderSAN(pos, move):
         cap = csrc[0] + 'x' if pos.board[j] != '.' or j == pos.ep else ''
         return cap + cdst + pro + check
     # Figure out what files and ranks we need to include
-    srcs = [a for (a,b),_ in gen_legal_moves(pos) if pos.board[a] == pos.board[i] and b == j]
+    srcs = [a for a in _sources(pos, pos.board[i], j) if a == i or _legal(pos, (a, j))]
     srcs_file = [a for a in srcs if (a - sunfish.A1) % 10 == (i - sunfish.A1) % 10]
     srcs_rank = [a for a in srcs if (a - sunfish.A1) // 10 == (i - sunfish.A1) // 10]
     assert srcs, 'No moves compatible with {}'.format(move)
@@ -79,30 +100,49 @@ def renderSAN(pos, move):
     return p + src + cap + cdst + check
 
 def parseSAN(pos, msan):
-    ''' Assumes board is rotated to position of current player '''
-    # Normal moves
-    normal = re.match('([KQRBN])([a-h])?([1-8])?x?([a-h][1-8])', msan)
-    if normal:
-        p, fil, rank, dst = normal.groups()
-        src = (fil or '[a-h]')+(rank or '[1-8]')
-    # Pawn moves
-    pawn = re.match('([a-h])?x?([a-h][1-8])', msan)
-    if pawn:
-        p, (fil, dst) = 'P', pawn.groups()
-        src = (fil or '[a-h]')+'[1-8]'
+    ''' Assumes board is rotated to position of current player. Rather than
+    trying all legal moves, the move is found from its destination square.
+    Promotions are always to a queen, as in mrender. '''
+    color = get_color(pos)
+    square = lambda c: sunfish.parse(c) if color == WHITE else 119-sunfish.parse(c)
+    msan = msan.rstrip('+#!?')
     # Castling
-    if re.match(msan, "O-O-O[+#]?"):
-        p, src, dst = 'K', 'e[18]', 'c[18]'
-    if re.match(msan, "O-O[+#]?"):
-        p, src, dst = 'K', 'e[18]', 'g[18]'
-    # Find possible match
-    for (i, j), _ in gen_legal_moves(pos):
-        if get_color(pos) == WHITE:
-            csrc, cdst = sunfish.render(i), sunfish.render(j)
-        else: csrc, cdst = sunfish.render(119-i), sunfish.render(119-j)
-        if pos.board[i] == p and re.match(dst,cdst) and re.match(src,csrc):
-            return (i, j)
-    assert False
+    if msan in ('O-O', '0-0'):
+        return mparse(color, 'e1g1' if color == WHITE else 'e8g8')
+    if msan in ('O-O-O', '0-0-0'):
+        return mparse(color, 'e1c1' if color == WHITE else 'e8c8')
+    m = re.match(r'([KQRBN])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([QRBN]))?$', msan)
+    assert m, 'Not a SAN move: {}'.format(msan)
+    p, fil, rank, dst, promotion = m.groups()
+    if promotion not in (None, 'Q'):
+        raise ValueError('Sunfish only promotes to queens: {}'.format(msan))
+    j = square(dst)
+    # Pawn moves
+    if p is None:
+        if fil is not None and fil != dst[0]:
+            behind = int(dst[1]) - 1 if color == WHITE else int(dst[1]) + 1
+            i = square(fil + str(behind))
+            if pos.board[i] != 'P' or not (pos.board[j].islower() or j == pos.ep):
+                raise ValueError('No pawn capture matches {}'.format(msan))
+            return i, j
+        if pos.board[j] != '.':
+            raise ValueError('No pawn push matches {}'.format(msan))
+        if pos.board[j+sunfish.S] == 'P':
+            return j+sunfish.S, j
+        # A double push, from the second rank over an empty square
+        i = j+2*sunfish.S
+        if pos.board[j+sunfish.S] != '.' or pos.board[i] != 'P' \
+                or not sunfish.A1+sunfish.N <= i <= sunfish.H1+sunfish.N:
+            raise ValueError('No pawn push matches {}'.format(msan))
+        return i, j
+    # Other pieces, disambiguated by the file or rank given, or else by pins
+    render = lambda i: sunfish.render(i if color == WHITE else 119-i)
+    srcs = [i for i in _sources(pos, p, j)
+            if (fil is None or render(i)[0] == fil) and (rank is None or render(i)[1] == rank)]
+    if len(srcs) > 1:
+        srcs = [i for i in srcs if _legal(pos, (i, j))]
+    assert len(srcs) == 1, 'No single move matches {}'.format(msan)
+    return srcs[0], j
 
 ################################################################################
 # Parse and Render positions
@@ -112,8 +152,9 @@ def get_color(pos):
     ''' A slightly hacky way to to get the color from a sunfish position '''
     return BLACK if pos.board.startswith('\n') else WHITE
 
-def parseFEN(fen):
-    """ Parses a string in Forsyth-Edwards Notation into a Position """
+def parseFEN(fen, position=sunfish.Position):
+    """ Parses a string in Forsyth-Edwards Notation into a Position.
+        Another Position class, such as bitboard.Position, may be given. """
     board, color, castling, enpas, _hclock, _fclock = fen.split()
     board = re.sub(r'\d', (lambda m: '.'*int(m.group(0))), board)
     board = list(21*' ' + '  '.join(board.split('/')) + 21*' ')
@@ -126,7 +167,7 @@ def parseFEN(fen):
     ep = sunfish.parse(enpas) if enpas != '-' else 0
     score = sum(sunfish.pst[p][i] for i,p in enumerate(board) if p.isupper())
     score -= sum(sunfish.pst[p.upper()][119-i] for i,p in enumerate(board) if p.islower())
-    pos = sunfish.Position(board, score, wc, bc, ep, 0)
+    pos = position(board, score, wc, bc, ep, 0)
     return pos if color == 'w' else pos.rotate()
 
 def renderFEN(pos, half_move_clock=0, full_move_clock=1):
@@ -157,6 +198,96 @@ def parseEPD(epd, opt_dict=False):
         opts = dict(p.split(maxsplit=1) for p in opts)
     return fen, opts
 
+################################################################################
+# Parse and Render games
+################################################################################
+
+# The tokens of PGN movetext, and the tags every game has
+_pgn_token = re.compile(r'\{[^}]*\}|\{.*|;.*|\(|\)|\$\d+|1-0|0-1|1/2-1/2|\*|\d+\.+|[^\s{}();$.]+')
+PGN_RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+PGN_TAGS = ('Event', 'Site', 'Date', 'Round', 'White', 'Black', 'Result')
+
+def readPGN(lines):
+    ''' Yields (tags, moves) for each game of the PGN lines, e.g. an open
+    file, as they are read. tags is a dict of the tag pairs, and its Result is
+    the game termination marker. The moves are played from tags['FEN'], or
+    the initial position, and each is relative to the player making it, as
+    in parseSAN. Comments, variations and NAGs are skipped. A game is cut
+    short at a move that can't be played, e.g. after an underpromotion. '''
+    tags, sans = {}, []
+    comment, variation = False, 0
+    for line in lines:
+        if comment:
+            if '}' not in line: continue
+            line, comment = line[line.index('}')+1:], False
+        if line.startswith('[') and not variation:
+            # Tags after moves start the next game
+            if sans:
+                yield _pgn_game(tags, sans)
+                tags, sans = {}, []
+            tag = re.match(r'\[(\w+)\s+"(.*)"\]', line)
+            if tag: tags[tag.group(1)] = tag.group(2).replace('\\"', '"')
+            continue
+        for token in _pgn_token.findall(line):
+            if token == '(': variation += 1
+            elif token == ')': variation -= 1
+            elif token[0] == '{':
+                # A comment going on to the next lines
+                comment = not token.endswith('}')
+            elif variation or token[0] in ';$' or token[0].isdigit() and token.endswith('.'):
+                continue
+            elif token in PGN_RESULTS:
+                tags['Result'] = token
+                yield _pgn_game(tags, sans)
+                tags, sans = {}, []
+            else:
+                sans.append(token)
+    if tags or sans:
+        yield _pgn_game(tags, sans)
+
+def _pgn_game(tags, sans):
+    pos = parseFEN(tags.get('FEN', FEN_INITIAL))
+    moves = []
+    for msan in sans:
+        try:
+            move = parseSAN(pos, msan)
+        except (AssertionError, ValueError):
+            break
+        moves.append(move)
+        pos = pos.move(move)
+    return tags, moves
+
+def writePGN(out, games):
+    ''' Writes the (tags, moves) of games, like those of readPGN, to the file
+    out. Missing tags of the seven tag roster are written as unknown. '''
+    for tags, moves in games:
+        tags = dict(tags)
+        for tag in PGN_TAGS:
+            tags.setdefault(tag, '????.??.??' if tag == 'Date' else '*' if tag == 'Result' else '?')
+        for tag in PGN_TAGS + tuple(t for t in tags if t not in PGN_TAGS):
+            out.write('[{} "{}"]\n'.format(tag, tags[tag].replace('"', '\\"')))
+        out.write('\n')
+        fen = tags.get('FEN', FEN_INITIAL)
+        pos = parseFEN(fen)
+        number = int(fen.split()[5]) if len(fen.split()) > 5 else 1
+        words = [] if get_color(pos) == WHITE else ['{}...'.format(number)]
+        for move in moves:
+            if get_color(pos) == WHITE:
+                words.append('{}.'.format(number))
+            else:
+                number += 1
+            words.append(renderSAN(pos, move))
+            pos = pos.move(move)
+        words.append(tags['Result'])
+        # Movetext lines are kept within 80 characters
+        line = ''
+        for word in words:
+            if line and len(line) + 1 + len(word) > 80:
+                out.write(line + '\n')
+                line = ''
+            line = line + ' ' + word if line else word
+        out.write(line + '\n\n')
+
 ################################################################################
 # Pretty print
 ################################################################################
@@ -169,7 +300,7 @@ def pv(searcher, pos, include_scores=True):
     if include_scores:
         res.append(str(pos.score))
     while True:
-        move = searcher.tp_move.get(pos)
+        move = searcher.tp.get_move(pos.hash)
         if move is None:
             break
         res.append(mrender(pos, move))
@@ -211,3 +342,148 @@ def flatten_tree(tree, depth):
         for pos in flatten_tree(subtree, depth-1):
             yield pos
 
+
+################################################################################
+# Match statistics
+################################################################################
+
+class SPRT:
+    """ Sequential probability ratio test of the hypotheses that the first
+    engine is elo0 or elo1 Elo stronger than the second, with error rates
+    alpha and beta. Results are added one game at a time, and the log
+    likelihood ratio uses the normal approximation of the game scores, so
+    draws count as half a win. """
+
+    def __init__(self, elo0=0, elo1=10, alpha=.05, beta=.05):
+        score = lambda elo: 1 / (1 + 10**(-elo/400))
+        self.s0, self.s1 = score(elo0), score(elo1)
+        self.lower = math.log(beta / (1-alpha))
+        self.upper = math.log((1-beta) / alpha)
+        self.wins = self.draws = self.losses = 0
+
+    def add(self, result):
+        """ Adds a game, 1 if the first engine won, 0 for a draw and -1 if
+        it lost """
+        if result > 0: self.wins += 1
+        elif result < 0: self.losses += 1
+        else: self.draws += 1
+
+    def llr(self):
+        n = self.wins + self.draws + self.losses
+        if n == 0:
+            return 0.
+        w, d = self.wins / n, self.draws / n
+        s = w + d/2
+        var = w + d/4 - s*s
+        if var <= 0:
+            return 0.
+        return n * (self.s1 - self.s0) * (2*s - self.s0 - self.s1) / (2*var)
+
+    def status(self):
+        """ 1 if elo1 is accepted, -1 if elo0 is, and 0 while undecided """
+        llr = self.llr()
+        return 1 if llr >= self.upper else -1 if llr <= self.lower else 0
+
+    def __str__(self):
+        return '{}-{}-{} LLR {:.2f} ({:.2f}, {:.2f})'.format(
+            self.wins, self.draws, self.losses, self.llr(), self.lower, self.upper)
+
+################################################################################
+# Searching in the background
+################################################################################
+
+class Thinker(threading.Thread):
+    ''' A search of pos, either in the background by start() or in the
+    foreground by run(). It ends at depth, or within the limits of clock, a
+    timeman.TimeManager, or at stop(). The hard limit and stop() are checked
+    every few nodes, keeping the result of the last full depth.
+    A pondering search, on the opponent's time, has no limits until
+    ponderhit(), which starts the clock. It doesn't end before ponderhit() or
+    stop() even when the search is done, as the protocols require. The search
+    fills the transposition table of searcher, so if the opponent plays
+    another move, the next search still starts warm.
+    report is called with the thinker after each depth, and finish at the
+    end. '''
+
+    def __init__(self, searcher, pos, clock=None, depth=None, ponder=False,
+                 report=None, finish=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.searcher, self.pos = searcher, pos
+        self.clock, self.depth = clock, depth
+        self.pondering = ponder
+        self.report, self.finish = report, finish
+        self.stopped = threading.Event()
+        self.woken = threading.Event()
+        self.start_time = time.time()
+
+    def run(self):
+        self.searcher.should_stop = self.should_stop
+        for _ in self.searcher._search(self.pos):
+            if self.report is not None:
+                self.report(self)
+            if self.stopped.is_set() or not self.pondering and self.done():
+                break
+        while self.pondering and not self.stopped.is_set():
+            self.woken.wait()
+            self.woken.clear()
+        self.searcher.should_stop = None
+        if self.finish is not None:
+            self.finish(self)
+
+    def should_stop(self):
+        ''' Polled by the search, which stops in the middle of a depth '''
+        if self.stopped.is_set():
+            return True
+        return not self.pondering and self.clock is not None and self.clock.out_of_time()
+
+    def done(self):
+        ''' Whether to stop after a depth '''
+        if self.depth is not None and self.searcher.depth >= self.depth:
+            return True
+        move = self.searcher.tp.get_move(self.pos.hash)
+        return self.clock is not None and not self.clock.next_depth(move)
+
+    def ponderhit(self, clock=None):
+        ''' The opponent played the move we pondered on, so the clock starts,
+        which is replaced by clock if given '''
+        if clock is not None:
+            self.clock = clock
+        if self.clock is not None:
+            self.clock.restart()
+        self.start_time = time.time()
+        self.pondering = False
+        self.woken.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.woken.set()
+
+    def best(self):
+        ''' The best move found and its score '''
+        tp, pos = self.searcher.tp, self.pos
+        return tp.get_move(pos.hash), tp.get(pos.hash, self.searcher.depth, True)[0]
+
+
+class Input(threading.Thread):
+    ''' Reads the lines of stream into a queue in the background, so that
+    commands are read while a search runs. Other threads may put things in the
+    queue too, like a Thinker that is done. At the end of the stream the line
+    is 'quit'. '''
+
+    def __init__(self, stream=sys.stdin):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stream = stream
+        self.queue = queue.Queue()
+
+    def run(self):
+        for line in iter(self.stream.readline, ''):
+            self.queue.put(line.rstrip('\r\n'))
+        self.queue.put('quit')
+
+    def get(self):
+        return self.queue.get()
+
+    def put(self, item):
+        self.queue.put(item)
@@ -10,18 +10,62 @@ import time
 
 import tools
 import sunfish
+import parallel
+import book
+import tablebase
+import timeman
 
 from tools import WHITE, BLACK
-from xboard import Unbuffered, sunfish, input
+from xboard import Unbuffered, sunfish
 sys.stdout = Unbuffered(sys.stdout)
 
+def new_searcher(hash_mb, threads, pvs, tablebases):
+    if threads > 1:
+        searcher = parallel.ParallelSearcher(threads, hash_mb)
+    else:
+        searcher = sunfish.Searcher(hash_mb)
+    searcher.pvs = pvs
+    searcher.tablebase = tablebases
+    return searcher
+
+def info(thinker):
+    searcher, pos = thinker.searcher, thinker.pos
+    moves = tools.pv(searcher, pos, include_scores=False)
+    lower, upper = searcher.tp.get(pos.hash, searcher.depth, True)
+    score = int(round((lower + upper)/2))
+    usedtime = int((time.time() - thinker.start_time) * 1000)
+    moves_str = moves if len(moves) < 15 else ''
+    nodes = searcher.nodes + sum(getattr(searcher, 'helper_nodes', ()))
+    print('info depth {} score {} time {} nodes {} {}'.format(searcher.depth, score, usedtime, nodes, moves_str))
+
+def bestmove(thinker):
+    m, s = thinker.best()
+    # We only resign once we are mated.. That's never?
+    if s == -sunfish.MATE_UPPER:
+        print('resign')
+    else:
+        # The second move of the pv is the one to ponder on
+        moves = tools.pv(thinker.searcher, thinker.pos, include_scores=False).split(' ')
+        if len(moves) > 1:
+            print('bestmove ' + moves[0] + ' ponder ' + moves[1])
+        else:
+            print('bestmove ' + moves[0])
+
 def main():
-    pos = tools.parseFEN(tools.FEN_INITIAL)
-    searcher = sunfish.Searcher()
+    pos = tools.parseFEN(tools.FEN_INITIAL, sunfish.Position)
+    hash_mb, threads, pvs = sunfish.TABLE_SIZE, 1, False
+    tablebases = tablebase.load()
+    searcher = new_searcher(hash_mb, threads, pvs, tablebases)
+    opening_book, own_book = book.load(), True
     forced = False
     color = WHITE
     our_time, opp_time = 1000, 1000 # time in centi-seconds
     show_thinking = True
+    # The search of go, which runs in the background while we read commands.
+    # When it is done, it is put with the commands.
+    thinker = None
+    commands = tools.Input()
+    commands.start()
 
     # print name of chess engine
     print('Sunfish')
@@ -30,14 +74,61 @@ def main():
     while True:
         if stack:
             smove = stack.pop()
-        else: smove = input()
+        else: smove = commands.get()
+
+        if isinstance(smove, tools.Thinker):
+            if smove is thinker:
+                bestmove(thinker)
+                thinker = None
+            continue
+
+        # Anything but these ends the search, like stop
+        if thinker is not None and smove not in ('ponderhit', 'isready'):
+            thinker.stop()
+            thinker.join()
+            bestmove(thinker)
+            thinker = None
 
         if smove == 'quit':
+            if threads > 1:
+                searcher.close()
             break
 
         elif smove == 'uci':
+            print('id name Sunfish')
+            print('option name Hash type spin default {} min 1 max 4096'.format(sunfish.TABLE_SIZE))
+            print('option name Threads type spin default 1 min 1 max 64')
+            print('option name PVS type check default false')
+            print('option name Ponder type check default false')
+            print('option name OwnBook type check default true')
+            print('option name BookFile type string default {}'.format(book.BOOK))
+            print('option name TablebasePath type string default {}'.format(tablebase.TABLEBASES))
             print('uciok')
 
+        elif smove.startswith('setoption'):
+            # setoption name <id> value <x>
+            params = smove.split()
+            if len(params) == 5 and params[2].lower() in ('hash', 'threads'):
+                if threads > 1:
+                    searcher.close()
+                if params[2].lower() == 'hash':
+                    hash_mb = int(params[4])
+                else:
+                    threads = int(params[4])
+                searcher = new_searcher(hash_mb, threads, pvs, tablebases)
+            if len(params) == 5 and params[2].lower() == 'pvs':
+                pvs = searcher.pvs = params[4].lower() == 'true'
+            if len(params) == 5 and params[2].lower() == 'ownbook':
+                own_book = params[4].lower() == 'true'
+            if len(params) >= 5 and params[2].lower() == 'bookfile':
+                if opening_book:
+                    opening_book.close()
+                opening_book = book.load(smove.split(' value ', 1)[1])
+            if len(params) >= 5 and params[2].lower() == 'tablebasepath':
+                if tablebases:
+                    tablebases.close()
+                tablebases = searcher.tablebase = tablebase.load(smove.split(' value ', 1)[1])
+
         elif smove == 'isready':
             print('readyok')
 
@@ -45,16 +136,24 @@ def main():
             stack.append('position fen ' + tools.FEN_INITIAL)
 
         elif smove.startswith('position'):
+            # position (startpos | fen <fen>) [moves <move> ...]
+            smove, _, moves = smove.partition(' moves ')
             params = smove.split(' ', 2)
-            if params[1] == 'fen':
-                fen = params[2]
-                pos = tools.parseFEN(fen)
-                color = WHITE if fen.split()[1] == 'w' else BLACK
+            fen = params[2] if params[1] == 'fen' else tools.FEN_INITIAL
+            pos = tools.parseFEN(fen, sunfish.Position)
+            color = WHITE if fen.split()[1] == 'w' else BLACK
+            for move in moves.split():
+                pos = pos.move(tools.mparse(color, move))
+                color = 1-color
 
         elif smove.startswith('go'):
             #  default options
             depth = 1000
             movetime = -1
+            ponder = False
+            # The clocks and increments of white and black, in milliseconds
+            clocks, incs = [None, None], [0, 0]
+            movestogo = None
 
             # parse parameters
             params = smove.split(' ')
@@ -69,44 +168,44 @@ def main():
                 if param == 'movetime':
                     i += 1
                     movetime = int(params[i])
+                if param == 'ponder':
+                    ponder = True
+                if param in ('wtime', 'btime'):
+                    i += 1
+                    clocks[param[0] == 'b'] = int(params[i])
+                if param in ('winc', 'binc'):
+                    i += 1
+                    incs[param[0] == 'b'] = int(params[i])
+                if param == 'movestogo':
+                    i += 1
+                    movestogo = int(params[i])
                 i += 1
 
             forced = False
 
-            moves_remain = 40
-
-            start = time.time()
-            ponder = None
-            for _ in searcher._search(pos):
-                moves = tools.pv(searcher, pos, include_scores=False)
-
-                if show_thinking:
-                    entry = searcher.tp_score.get((pos, searcher.depth, True))
-                    score = int(round((entry.lower + entry.upper)/2))
-                    usedtime = int((time.time() - start) * 1000)
-                    moves_str = moves if len(moves) < 15 else ''
-                    print('info depth {} score {} time {} nodes {} {}'.format(searcher.depth, score, usedtime, searcher.nodes, moves_str))
-
-                if len(moves) > 5:
-                    ponder = moves[1]
-
-                if movetime > 0 and (time.time() - start) * 1000 > movetime:
-                    break
-
-                if searcher.depth >= depth:
-                    break
-
-            entry = searcher.tp_score.get((pos, searcher.depth, True))
-            m, s = searcher.tp_move.get(pos), entry.lower
-            # We only resign once we are mated.. That's never?
-            if s == -sunfish.MATE_UPPER:
-                print('resign')
-            else:
-                moves = moves.split(' ')
-                if len(moves) > 1:
-                    print('bestmove ' + moves[0] + ' ponder ' + moves[1])
-                else:
-                    print('bestmove ' + moves[0])
+            # Book moves are played without searching
+            m = not ponder and own_book and opening_book and opening_book.choose(pos)
+            if m:
+                print('bestmove ' + tools.mrender(pos, m))
+                continue
+
+            if movetime > 0:
+                clock = timeman.TimeManager(movetime=movetime/1000)
+            elif clocks[color] is not None:
+                clock = timeman.TimeManager(clocks[color]/1000, incs[color]/1000, movestogo)
+            else: clock = None
+
+            # A ponder search goes on until ponderhit or stop
+            thinker = tools.Thinker(searcher, pos, clock, depth,
+                              ponder, info if show_thinking else None, commands.put)
+            thinker.start()
+
+        elif smove == 'ponderhit':
+            if thinker is not None:
+                thinker.ponderhit()
+
+        elif smove == 'stop':
+            pass
 
         elif smove.startswith('time'):
             our_time = int(smove.split()[1])
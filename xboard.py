@@ -6,44 +6,107 @@ from __future__ import division
 import importlib
 import re
 import sys
+import threading
 import time
 
 import tools
 import sunfish
+import book
+import tablebase
+import timeman
 
 from tools import WHITE, BLACK
 
 if len(sys.argv) > 1:
     sunfish = importlib.import_module(sys.argv[1])
 
-# Python 2 compatability
-if sys.version_info[0] == 2:
-    input = raw_input
-
-# Disable buffering
+# Disable buffering. Whole lines are written at once, so the lines printed by
+# a search in the background don't get mixed up with the others.
 class Unbuffered(object):
     def __init__(self, stream):
         self.stream = stream
+        self.lock = threading.Lock()
+        self.local = threading.local()
     def write(self, data):
-        self.stream.write(data)
-        self.stream.flush()
+        data = getattr(self.local, 'line', '') + data
+        lines, newline, self.local.line = data.rpartition('\n')
+        if newline:
+            with self.lock:
+                self.stream.write(lines + newline)
+                self.stream.flush()
     def __getattr__(self, attr):
         return getattr(self.stream, attr)
 sys.stdout = Unbuffered(sys.stdout)
 
+def post(thinker):
+    """ Prints the thinking output of xboard """
+    searcher, pos = thinker.searcher, thinker.pos
+    ply = searcher.depth
+    lower, upper = searcher.tp.get(pos.hash, ply, True)
+    score = int(round((lower + upper)/2))
+    used = int((time.time() - thinker.start_time)*100 + .5)
+    moves = tools.pv(searcher, pos, include_scores=False)
+    print('{:>3} {:>8} {:>8} {:>13} \t{}'.format(
+        ply, score, used, searcher.nodes, moves))
+
 def main():
-    pos = tools.parseFEN(tools.FEN_INITIAL)
+    pos = tools.parseFEN(tools.FEN_INITIAL, sunfish.Position)
     searcher = sunfish.Searcher()
+    tablebases = searcher.tablebase = tablebase.load()
+    opening_book = book.load()
     forced = False
     color = WHITE
     our_time, opp_time = 1000, 1000 # time in centi-seconds
+    # The moves and increment of the time control of level, the seconds per
+    # move of st, and the moves we made since new or setboard
+    mps, inc, st = 0, 0, None
+    moves = 0
     show_thinking = False
+    # Whether to ponder, and the ponder search with the move it expects
+    ponder = False
+    thinker, ponder_move = None, None
+    # Commands are read while searching, and the searches are done in the
+    # background. When one is done, it is put with the commands.
+    commands = tools.Input()
+    commands.start()
 
     stack = []
     while True:
         if stack:
             smove = stack.pop()
-        else: smove = input()
+        else: smove = commands.get()
+
+        # Our search is done, so we move and ponder on the reply. A stopped
+        # search is not played.
+        if isinstance(smove, tools.Thinker):
+            if smove is not thinker:
+                continue
+            m, s = thinker.best()
+            thinker = None
+            # We only resign once we are mated.. That's never?
+            if s == -sunfish.MATE_UPPER:
+                print('resign')
+            else:
+                print('move', tools.mrender(pos, m))
+                pos = pos.move(m)
+                color = 1-color
+                moves += 1
+                # Ponder on the reply we expect
+                ponder_move = searcher.tp.get_move(pos.hash)
+                if ponder and ponder_move:
+                    thinker = tools.Thinker(searcher, pos.move(ponder_move), ponder=True,
+                                      report=post if show_thinking else None,
+                                      finish=commands.put)
+                    thinker.start()
+            continue
+
+        # Most commands end the search, without a move. See usermove and easy
+        # for the ponder search.
+        if thinker is not None and not smove.startswith(
+                ('usermove', 'go', 'time', 'otim', 'ping', 'post', 'nopost', '?', 'hard', 'easy')):
+            thinker.stop()
+            thinker.join()
+            thinker = None
 
         if smove == 'quit':
             break
@@ -55,6 +118,7 @@ def main():
             print('feature setboard=1')
             print('feature ping=1')
             print('feature sigint=0')
+            print('feature memory=1')
             print('feature variants="normal"')
             print('feature done=1')
 
@@ -63,7 +127,8 @@ def main():
 
         elif smove.startswith('setboard'):
             _, fen = smove.split(' ', 1)
-            pos = tools.parseFEN(fen)
+            pos = tools.parseFEN(fen, sunfish.Position)
+            moves = 0
             color = WHITE if fen.split()[1] == 'w' else BLACK
 
         elif smove == 'force':
@@ -72,34 +137,37 @@ def main():
         elif smove == 'go':
             forced = False
 
-            moves_remain = 40
-            use = our_time/moves_remain
-            # Let's follow the clock of our opponent
-            if our_time >= 100 and opp_time >= 100:
-                use *= our_time/opp_time
-            
-            start = time.time()
-            for _ in searcher._search(pos):
-                if show_thinking:
-                    ply = searcher.depth
-                    entry = searcher.tp_score.get((pos, ply, True))
-                    score = int(round((entry.lower + entry.upper)/2))
-                    dual_score = '{}:{}'.format(entry.lower, entry.upper)
-                    used = int((time.time() - start)*100 + .5)
-                    moves = tools.pv(searcher, pos, include_scores=False)
-                    print('{:>3} {:>8} {:>8} {:>13} \t{}'.format(
-                        ply, score, used, searcher.nodes, moves))
-                if time.time() - start > use/100:
-                    break
-            entry = searcher.tp_score.get((pos, searcher.depth, True))
-            m, s = searcher.tp_move.get(pos), entry.lower
-            # We only resign once we are mated.. That's never?
-            if s == -sunfish.MATE_UPPER:
-                print('resign')
+            if st is not None:
+                clock = timeman.TimeManager(movetime=st)
             else:
+                clock = timeman.TimeManager(our_time/100, inc, mps - moves % mps if mps else None)
+
+            # Book moves are played without searching
+            m = opening_book and opening_book.choose(pos)
+            if thinker is not None and (m or thinker.pos.hash != pos.hash):
+                thinker.stop()
+                thinker.join()
+                thinker = None
+            if m:
                 print('move', tools.mrender(pos, m))
                 pos = pos.move(m)
                 color = 1-color
+                moves += 1
+                continue
+
+            # After a ponder hit the ponder search goes on, now on our time
+            if thinker is not None:
+                thinker.report = post if show_thinking else None
+                thinker.ponderhit(clock)
+            else:
+                thinker = tools.Thinker(searcher, pos, clock, report=post if show_thinking else None,
+                                        finish=commands.put)
+                thinker.start()
+
+        elif smove == '?':
+            # Move now
+            if thinker is not None and not thinker.pondering:
+                thinker.stop()
 
         elif smove.startswith('ping'):
             _, N = smove.split()
@@ -108,17 +176,34 @@ def main():
         elif smove.startswith('usermove'):
             _, smove = smove.split()
             m = tools.mparse(color, smove)
+            # Unless we pondered on this move, the ponder search is wasted
+            if thinker is not None and (m != ponder_move or forced):
+                thinker.stop()
+                thinker.join()
+                thinker = None
             pos = pos.move(m)
             color = 1-color
             if not forced:
                 stack.append('go')
 
+        elif smove.startswith('memory'):
+            searcher = sunfish.Searcher(int(smove.split()[1]))
+            searcher.tablebase = tablebases
+
         elif smove.startswith('time'):
             our_time = int(smove.split()[1])
         
         elif smove.startswith('otim'):
             opp_time = int(smove.split()[1])
 
+        elif smove.startswith('level'):
+            # level MPS BASE INC, the clock itself comes with time
+            _, mps, _, inc = smove.split()
+            mps, inc, st = int(mps), float(inc), None
+
+        elif smove.startswith('st '):
+            st = float(smove.split()[1])
+
         elif smove.startswith('perft'):
             start = time.time()
             for d in range(1,10):
@@ -131,7 +216,17 @@ def main():
         elif smove.startswith('nopost'):
             show_thinking = False
 
-        elif any(smove.startswith(x) for x in ('xboard','random','hard','accepted','level')):
+        elif smove == 'hard':
+            ponder = True
+
+        elif smove == 'easy':
+            ponder = False
+            if thinker is not None and thinker.pondering:
+                thinker.stop()
+                thinker.join()
+                thinker = None
+
+        elif any(smove.startswith(x) for x in ('xboard','random','accepted')):
             pass
 
         else: